@@ -0,0 +1,244 @@
+"""Threshold alerts on freshly drift-corrected water levels
+
+Runs right after `correct_drift`, on just the rows newer than the last reading evaluated for each
+sensor. A sensor starts flooding when `road_water_level_adj` reaches its `alert_threshold` and only
+stops once the level falls `ALERT_HYSTERESIS_FT` below it, so readings hovering at the threshold do
+not flap. The flooding state of every sensor is saved between runs.
+
+Loading, evaluating and saving the state of a sensor happens under a per-sensor advisory lock, so
+the event listener and a scheduled drift run that overlap take turns instead of both acting on the
+same state. Events are unique per (place, sensor_ID, date, event) as a second guard.
+
+Events are written to the `alert_events` outbox table. With a webhook URL (`ALERT_WEBHOOK_URL`,
+read by the entry points), undelivered events are also POSTed there as JSON and marked delivered.
+"""
+
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import requests
+from sqlalchemy import text
+
+from atm_pressure import postgres_upsert
+
+STATE_TABLE = "alert_state"
+EVENTS_TABLE = "alert_events"
+
+CREATE_ALERT_TABLES = f"""
+CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    flooding boolean NOT NULL,
+    last_date timestamptz NOT NULL,
+    road_water_level_adj double precision,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT {STATE_TABLE}_pkey PRIMARY KEY (place, "sensor_ID")
+);
+
+CREATE TABLE IF NOT EXISTS {EVENTS_TABLE} (
+    id bigserial PRIMARY KEY,
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    date timestamptz NOT NULL,
+    event text NOT NULL,
+    road_water_level_adj double precision,
+    alert_threshold double precision,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    delivery_attempts integer NOT NULL DEFAULT 0,
+    delivered_at timestamptz
+);
+
+CREATE INDEX IF NOT EXISTS {EVENTS_TABLE}_undelivered_idx ON {EVENTS_TABLE} (id) WHERE delivered_at IS NULL;
+
+-- Tables created before events were unique may hold duplicates; keep the first of each
+DO $$
+BEGIN
+    IF to_regclass('{EVENTS_TABLE}_key') IS NULL THEN
+        DELETE FROM {EVENTS_TABLE} a USING {EVENTS_TABLE} b
+        WHERE a.id > b.id AND a.place = b.place AND a."sensor_ID" = b."sensor_ID" AND a.date = b.date AND a.event = b.event;
+        CREATE UNIQUE INDEX {EVENTS_TABLE}_key ON {EVENTS_TABLE} (place, "sensor_ID", date, event);
+    END IF;
+END
+$$;
+"""
+
+# Drop below the threshold by this much (ft) before a flooding sensor is cleared
+DEFAULT_ALERT_HYSTERESIS_FT = 0.1
+
+
+def alert_settings_from_env():
+    """Keyword arguments for `run_alerts` from `ALERT_HYSTERESIS_FT` and `ALERT_WEBHOOK_URL`"""
+    return {"hysteresis": float(os.environ.get("ALERT_HYSTERESIS_FT", DEFAULT_ALERT_HYSTERESIS_FT)),
+            "webhook_url": os.environ.get("ALERT_WEBHOOK_URL")}
+
+
+def create_alert_tables(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_ALERT_TABLES)
+
+
+def lock_sensors(conn, sensors):
+    """Take transaction-scoped advisory locks on (place, sensor_ID) pairs, in a fixed order so runs cannot deadlock"""
+    keys = sorted(f"{STATE_TABLE}:{place}:{sensor_ID}" for place, sensor_ID in sensors)
+
+    for key in keys:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": key})
+
+
+def get_alert_state(conn, sensors):
+    """Saved state of the given (place, sensor_ID) pairs"""
+    query = text(f"""
+        SELECT s.place, s."sensor_ID", s.flooding, s.last_date FROM {STATE_TABLE} s
+        JOIN unnest(CAST(:places AS text[]), CAST(:sensors AS text[])) AS t(place, sensor) ON s.place = t.place AND s."sensor_ID" = t.sensor
+    """)
+
+    state = pd.read_sql_query(query, conn, params = {"places": [p for p, _ in sensors], "sensors": [s for _, s in sensors]})
+    state["last_date"] = pd.to_datetime(state["last_date"], utc = True)
+
+    return state
+
+
+def insert_events(conn, events):
+    """Append events to the outbox, skipping any that are already recorded"""
+    query = text(f"""
+        INSERT INTO {EVENTS_TABLE} (place, "sensor_ID", date, event, road_water_level_adj, alert_threshold)
+        VALUES (:place, :sensor_ID, :date, :event, :road_water_level_adj, :alert_threshold)
+        ON CONFLICT (place, "sensor_ID", date, event) DO NOTHING
+    """)
+
+    records = [{"place": e.place, "sensor_ID": e.sensor_ID, "date": e.date.to_pydatetime(), "event": e.event,
+                "road_water_level_adj": float(e.road_water_level_adj), "alert_threshold": float(e.alert_threshold)}
+               for e in events.itertuples(index = False)]
+
+    conn.execute(query, records)
+
+
+def evaluate_alerts(x, state, hysteresis = DEFAULT_ALERT_HYSTERESIS_FT):
+    """Find threshold crossings with hysteresis, per sensor
+
+    Args:
+        x (pd.DataFrame): Drift-corrected rows indexed by place, sensor_ID and date
+        state (pd.DataFrame): Saved state, one row per sensor with `flooding` and `last_date`
+        hysteresis (float): Distance below the threshold at which flooding ends
+
+    Returns:
+        tuple: Events (pd.DataFrame) and the new state of every evaluated sensor (pd.DataFrame)
+    """
+    data = x.reset_index().loc[:, ["place", "sensor_ID", "date", "road_water_level_adj", "alert_threshold"]]
+    data["date"] = pd.to_datetime(data["date"], utc = True)
+    data = data.merge(state, on = ["place", "sensor_ID"], how = "left")
+
+    # Only readings the previous run did not see
+    data = data[data["last_date"].isna() | (data["date"] > data["last_date"])]
+    data = data.sort_values(["place", "sensor_ID", "date"]).reset_index(drop = True)
+
+    if data.shape[0] == 0:
+        return pd.DataFrame(), pd.DataFrame()
+
+    level = data["road_water_level_adj"].to_numpy(dtype = float)
+    threshold = data["alert_threshold"].to_numpy(dtype = float)
+
+    # 1 where a reading switches flooding on, 0 where it switches it off, NaN in the hysteresis band
+    signal = np.full(data.shape[0], np.nan)
+    signal[level < threshold - hysteresis] = 0
+    signal[level >= threshold] = 1
+
+    sensor = data.groupby(["place", "sensor_ID"], sort = False).ngroup().to_numpy()
+    initial = data["flooding"].fillna(False).astype(float).to_numpy()
+
+    flooding = pd.Series(signal).groupby(sensor).ffill().fillna(pd.Series(initial)).to_numpy()
+    previous = pd.Series(flooding).groupby(sensor).shift(1).fillna(pd.Series(initial)).to_numpy()
+
+    started = (flooding == 1) & (previous == 0)
+    ended = (flooding == 0) & (previous == 1)
+
+    events = data.loc[started | ended, ["place", "sensor_ID", "date", "road_water_level_adj", "alert_threshold"]].copy()
+    events.insert(3, "event", np.where(started[started | ended], "flood_start", "flood_end"))
+
+    last = np.r_[sensor[1:] != sensor[:-1], True]
+    new_state = data.loc[last, ["place", "sensor_ID", "date", "road_water_level_adj"]].rename(columns = {"date": "last_date"})
+    new_state["flooding"] = flooding[last] == 1
+    new_state["updated_at"] = pd.Timestamp.now(tz = "UTC")
+
+    return events, new_state
+
+
+def deliver_alerts(engine, url = None, limit = 500, timeout = 10):
+    """POST undelivered events from the outbox to a webhook, oldest first
+
+    Stops at the first failed delivery so events arrive in order; the rest are retried next run.
+
+    Returns:
+        int: Number of events delivered
+    """
+    if url is None:
+        return 0
+
+    events = pd.read_sql_query(text(f"SELECT * FROM {EVENTS_TABLE} WHERE delivered_at IS NULL ORDER BY id LIMIT :limit"), engine, params = {"limit": limit})
+
+    delivered = 0
+
+    for event in events.to_dict("records"):
+        payload = {"id": event["id"], "place": event["place"], "sensor_ID": event["sensor_ID"], "date": pd.Timestamp(event["date"]).isoformat(),
+                   "event": event["event"], "road_water_level_adj": event["road_water_level_adj"], "alert_threshold": event["alert_threshold"]}
+
+        try:
+            r = requests.post(url, json = payload, timeout = timeout)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            with engine.begin() as conn:
+                conn.execute(text(f"UPDATE {EVENTS_TABLE} SET delivery_attempts = delivery_attempts + 1 WHERE id = :id"), {"id": event["id"]})
+            warnings.warn(f"Error delivering alert {event['id']} to webhook: {e}")
+            break
+
+        with engine.begin() as conn:
+            conn.execute(text(f"UPDATE {EVENTS_TABLE} SET delivered_at = now(), delivery_attempts = delivery_attempts + 1 WHERE id = :id"), {"id": event["id"]})
+
+        delivered += 1
+
+    return delivered
+
+
+def run_alerts(x, engine, hysteresis = DEFAULT_ALERT_HYSTERESIS_FT, webhook_url = None, debug = True):
+    """Evaluate alerts on drift-corrected rows, record events and state, and deliver to the webhook
+
+    The state of the evaluated sensors is locked from loading it until the new state is saved.
+
+    Args:
+        x (pd.DataFrame): Output of `correct_drift`
+        engine (sqlalchemy.engine.Engine): Database engine
+        hysteresis (float): Distance below the threshold (ft) at which flooding ends
+        webhook_url (str): Deliver events to this URL. Default: only record them
+
+    Returns:
+        pd.DataFrame: New alert events
+    """
+    create_alert_tables(engine)
+
+    sensors = list(x.reset_index().loc[:, ["place", "sensor_ID"]].drop_duplicates().itertuples(index = False, name = None))
+
+    if len(sensors) == 0:
+        return pd.DataFrame()
+
+    with engine.begin() as conn:
+        lock_sensors(conn, sensors)
+
+        events, new_state = evaluate_alerts(x, get_alert_state(conn, sensors), hysteresis = hysteresis)
+
+        if new_state.shape[0] == 0:
+            return events
+
+        if events.shape[0] > 0:
+            insert_events(conn, events)
+        new_state.set_index(["place", "sensor_ID"]).to_sql(STATE_TABLE, conn, if_exists = "append", method = postgres_upsert)
+
+    if debug == True and events.shape[0] > 0:
+        print("####################################")
+        for event in events.itertuples():
+            print(f"- {event.event}: {event.place} / {event.sensor_ID} at {event.date:%Y-%m-%d %H:%M} UTC, {event.road_water_level_adj:.2f} ft (threshold {event.alert_threshold:.2f} ft)")
+        print("####################################")
+
+    deliver_alerts(engine, url = webhook_url)
+
+    return events
@@ -0,0 +1,371 @@
+import datetime
+import warnings
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from atm_pressure import get_atm_pressure, postgres_upsert
+
+########################
+# Grid settings        #
+########################
+
+GRID_TABLE = "atm_pressure_grid"
+FETCH_TABLE = "atm_grid_fetches"
+GRID_STEP = pd.Timedelta(minutes = 1)
+
+# Re-fetch this much before the end of the stored grid so that new grid points are
+# interpolated between a stored observation and the new ones
+FETCH_OVERLAP = datetime.timedelta(hours = 2)
+MAX_FETCH_SPAN = datetime.timedelta(days = 30)
+
+# A station's tail is not requested again within this long of the last request, unless the new
+# range reaches past what that request asked for. Nothing newer can have been published since
+TAIL_REFETCH_INTERVAL = datetime.timedelta(minutes = 10)
+
+CREATE_GRID_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {GRID_TABLE} (
+    atm_data_src text NOT NULL,
+    atm_station_id text NOT NULL,
+    date timestamptz NOT NULL,
+    pressure_mb double precision,
+    CONSTRAINT {GRID_TABLE}_pkey PRIMARY KEY (atm_data_src, atm_station_id, date)
+);
+
+CREATE TABLE IF NOT EXISTS {FETCH_TABLE} (
+    atm_data_src text NOT NULL,
+    atm_station_id text NOT NULL,
+    fetched_from timestamptz,
+    fetched_until timestamptz,
+    tail_fetched_at timestamptz,
+    CONSTRAINT {FETCH_TABLE}_pkey PRIMARY KEY (atm_data_src, atm_station_id)
+);
+"""
+
+
+class AtmGrid:
+    """Atmospheric pressure for one station on a regular time grid
+
+    A lookup for any timestamp is an index computation plus a two-point blend of the
+    neighbouring grid values. Timestamps outside of the grid return NaN.
+
+    Args:
+        start (pd.Timestamp): Timestamp of the first grid point (UTC)
+        step (pd.Timedelta): Spacing of the grid
+        values (np.ndarray): Pressure (mb) at each grid point. Missing points are NaN
+    """
+
+    def __init__(self, start, step, values):
+        self.start = pd.Timestamp(start)
+        self.step = pd.Timedelta(step)
+        self.values = np.asarray(values, dtype = float)
+
+    @classmethod
+    def from_series(cls, series, step = GRID_STEP):
+        """Build a grid from a date-indexed pressure series, leaving gaps as NaN"""
+        if series.empty:
+            return cls(pd.Timestamp(0, tz = "UTC"), step, np.array([]))
+
+        full_index = pd.date_range(series.index.min(), series.index.max(), freq = step)
+
+        return cls(full_index[0], step, series.reindex(full_index).to_numpy(dtype = float))
+
+    @property
+    def end(self):
+        return self.start + self.step * (self.values.size - 1)
+
+    def lookup(self, dates):
+        """Interpolate pressure at `dates`
+
+        Args:
+            dates (array-like): Timestamps to look up. Naive timestamps are treated as UTC
+
+        Returns:
+            np.ndarray: Pressure (mb) for each timestamp. NaN if outside of the grid
+        """
+        ns = pd.DatetimeIndex(pd.to_datetime(dates, utc = True)).asi8
+
+        if self.values.size < 2:
+            return np.full(ns.size, np.nan)
+
+        pos = (ns - self.start.value) / self.step.value
+        in_range = (pos >= 0) & (pos <= self.values.size - 1)
+
+        i = np.clip(np.floor(pos), 0, self.values.size - 2).astype(np.int64)
+        frac = pos - i
+
+        blended = self.values[i] * (1 - frac) + self.values[i + 1] * frac
+        blended[~in_range] = np.nan
+
+        return blended
+
+
+########################
+# Grid construction    #
+########################
+
+def fetch_atm_range(atm_id, atm_src, dt_min, dt_max):
+    """Retrieve raw atm observations for a time range, in chunks of at most 30 days
+
+    Args:
+        atm_id (str): ID of the atm pressure station
+        atm_src (str): Source of the atm pressure data
+        dt_min (pd.Timestamp): Beginning of the time range (UTC)
+        dt_max (pd.Timestamp): End of the time range (UTC)
+
+    Returns:
+        pd.DataFrame: Raw atm observations. Empty if the source returned nothing
+    """
+    dt_duration = dt_max - dt_min
+    chunks = max(int(np.ceil(dt_duration / MAX_FETCH_SPAN)), 1)
+    span = dt_duration / chunks
+
+    atm_chunks = []
+    for i in range(chunks):
+        d = get_atm_pressure(atm_id = atm_id,
+                             atm_src = atm_src,
+                             begin_date = (dt_min + span * i).strftime("%Y%m%d %H:%M"),
+                             end_date = (dt_min + span * (i + 1)).strftime("%Y%m%d %H:%M"))
+
+        if not isinstance(d, pd.DataFrame):
+            warnings.warn(f"No usable atm pressure data returned for: {atm_src} {atm_id}")
+            continue
+
+        atm_chunks.append(d)
+
+    if len(atm_chunks) == 0:
+        return pd.DataFrame(columns = ["id", "date", "pressure_mb", "notes"])
+
+    return pd.concat(atm_chunks).drop_duplicates()
+
+
+def resample_atm_to_grid(atm_data, step = GRID_STEP):
+    """Resample irregular atm observations onto a regular grid
+
+    Grid points between two observations are linearly interpolated in time, which
+    matches `interpolate(method='time')` on the raw observations.
+
+    Args:
+        atm_data (pd.DataFrame): Raw atm observations with `date` and `pressure_mb` columns
+        step (pd.Timedelta): Spacing of the grid
+
+    Returns:
+        pd.Series: Pressure (mb) indexed by grid timestamp. Only spans covered by observations
+    """
+    obs = atm_data.loc[:, ["date", "pressure_mb"]].copy()
+    obs["date"] = pd.to_datetime(obs["date"], utc = True)
+    obs["pressure_mb"] = pd.to_numeric(obs["pressure_mb"], errors = "coerce")
+    obs = obs.dropna().groupby("date")["pressure_mb"].mean().sort_index()
+
+    if obs.shape[0] < 2:
+        return pd.Series(dtype = float, name = "pressure_mb")
+
+    grid_index = pd.date_range(obs.index.min().ceil(step), obs.index.max().floor(step), freq = step)
+    grid_values = np.interp(grid_index.asi8, obs.index.asi8, obs.to_numpy())
+
+    return pd.Series(grid_values, index = grid_index, name = "pressure_mb")
+
+
+########################
+# Database functions   #
+########################
+
+def create_atm_grid_table(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_GRID_TABLE)
+
+
+def get_atm_grid_extent(engine, atm_src, atm_id):
+    """Return the (first, last) stored grid timestamps for a station, or None if it has no grid"""
+    query = text(f"SELECT min(date) AS grid_min, max(date) AS grid_max FROM {GRID_TABLE} WHERE atm_data_src = :src AND atm_station_id = :id")
+
+    with engine.connect() as conn:
+        row = conn.execute(query, {"src": str(atm_src), "id": str(atm_id)}).one()
+
+    if row.grid_min is None:
+        return None
+
+    return pd.Timestamp(row.grid_min).tz_convert("UTC"), pd.Timestamp(row.grid_max).tz_convert("UTC")
+
+
+def get_atm_fetch_state(engine, atm_src, atm_id):
+    """Return the range requested from the source for a station and when its tail was last requested, or None"""
+    query = text(f"SELECT fetched_from, fetched_until, tail_fetched_at FROM {FETCH_TABLE} WHERE atm_data_src = :src AND atm_station_id = :id")
+
+    with engine.connect() as conn:
+        row = conn.execute(query, {"src": str(atm_src), "id": str(atm_id)}).first()
+
+    if row is None:
+        return None
+
+    return tuple(None if value is None else pd.Timestamp(value).tz_convert("UTC") for value in row)
+
+
+def record_atm_fetch(engine, atm_src, atm_id, fetched_from, fetched_until, tail_fetched_at):
+    """Widen the requested range stored for a station, whether or not the source returned anything"""
+    query = text(f"""
+        INSERT INTO {FETCH_TABLE} (atm_data_src, atm_station_id, fetched_from, fetched_until, tail_fetched_at)
+        VALUES (:src, :id, :fetched_from, :fetched_until, :tail_fetched_at)
+        ON CONFLICT ON CONSTRAINT {FETCH_TABLE}_pkey DO UPDATE SET
+            fetched_from = least({FETCH_TABLE}.fetched_from, excluded.fetched_from),
+            fetched_until = greatest({FETCH_TABLE}.fetched_until, excluded.fetched_until),
+            tail_fetched_at = coalesce(excluded.tail_fetched_at, {FETCH_TABLE}.tail_fetched_at)
+    """)
+
+    with engine.begin() as conn:
+        conn.execute(query, {"src": str(atm_src), "id": str(atm_id), "fetched_from": fetched_from.to_pydatetime(),
+                             "fetched_until": fetched_until.to_pydatetime(),
+                             "tail_fetched_at": None if tail_fetched_at is None else tail_fetched_at.to_pydatetime()})
+
+
+def write_atm_grid(grid, atm_src, atm_id, engine):
+    if grid.empty:
+        return 0
+
+    grid_df = grid.rename_axis("date").reset_index()
+    grid_df["atm_data_src"] = str(atm_src); grid_df["atm_station_id"] = str(atm_id)
+    grid_df.set_index(["atm_data_src", "atm_station_id", "date"], inplace = True)
+
+    grid_df.to_sql(GRID_TABLE, engine, if_exists = "append", method = postgres_upsert, chunksize = 5000)
+
+    return grid_df.shape[0]
+
+
+def read_atm_grid(engine, atm_src, atm_id, begin_date, end_date):
+    """Read the stored grid for a station and time range
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        atm_src (str): Source of the atm pressure data
+        atm_id (str): ID of the atm pressure station
+        begin_date (pd.Timestamp): Beginning of the time range (UTC)
+        end_date (pd.Timestamp): End of the time range (UTC)
+
+    Returns:
+        AtmGrid: Grid for the requested range. Empty if nothing is stored
+    """
+    query = text(f"SELECT date, pressure_mb FROM {GRID_TABLE} WHERE atm_data_src = :src AND atm_station_id = :id AND date >= :begin_date AND date <= :end_date ORDER BY date")
+
+    grid_df = pd.read_sql_query(query, engine, params = {"src": str(atm_src), "id": str(atm_id), "begin_date": begin_date, "end_date": end_date})
+    grid_df["date"] = pd.to_datetime(grid_df["date"], utc = True)
+
+    return AtmGrid.from_series(grid_df.set_index("date")["pressure_mb"])
+
+
+def update_atm_grid(engine, atm_src, atm_id, begin_date, end_date):
+    """Extend the stored grid for a station under a per-station advisory lock
+
+    Sensors sharing a station may be processed by several workers at once. The lock makes them
+    take turns, and the fetch state `extend_atm_grid` records lets every worker after the first
+    skip the fetch. See `extend_atm_grid`.
+
+    Returns:
+        int: Number of grid rows written
+    """
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": f"{GRID_TABLE}:{atm_src}:{atm_id}"})
+
+        return extend_atm_grid(engine, atm_src, atm_id, begin_date, end_date)
+
+
+def extend_atm_grid(engine, atm_src, atm_id, begin_date, end_date):
+    """Extend the stored grid for a station so it covers `begin_date` to `end_date`
+
+    Only the parts of the range that are not already on the grid are fetched from the
+    atm pressure source. Every request is recorded in `atm_grid_fetches`, so a head the source
+    had no observations for is not requested again, and the tail is requested at most once per
+    `TAIL_REFETCH_INTERVAL` unless the range reaches past the last request.
+
+    Returns:
+        int: Number of grid rows written
+    """
+    begin_date = pd.to_datetime(begin_date, utc = True)
+    end_date = pd.to_datetime(end_date, utc = True)
+    now = pd.Timestamp.now(tz = "UTC")
+
+    extent = get_atm_grid_extent(engine, atm_src, atm_id)
+    fetched = get_atm_fetch_state(engine, atm_src, atm_id)
+
+    known_from = min([t for t in [None if extent is None else extent[0], None if fetched is None else fetched[0]] if t is not None], default = None)
+    needs_head = known_from is None or begin_date < known_from
+
+    tail_recent = (fetched is not None and fetched[2] is not None and fetched[2] >= now - TAIL_REFETCH_INTERVAL
+                   and fetched[1] >= min(end_date, fetched[2]))
+    needs_tail = not tail_recent and (extent is None or end_date > extent[1])
+
+    if extent is None:
+        fetch_ranges = [(begin_date, end_date)] if needs_head or needs_tail else []
+    else:
+        grid_min, grid_max = extent
+        fetch_ranges = []
+
+        if needs_head:
+            fetch_ranges.append((begin_date, grid_min + FETCH_OVERLAP))
+        if needs_tail:
+            fetch_ranges.append((grid_max - FETCH_OVERLAP, end_date))
+
+    rows_written = 0
+    for range_min, range_max in fetch_ranges:
+        atm_data = fetch_atm_range(atm_id = atm_id, atm_src = atm_src, dt_min = range_min, dt_max = range_max)
+        rows_written += write_atm_grid(resample_atm_to_grid(atm_data), atm_src, atm_id, engine)
+
+    if len(fetch_ranges) > 0:
+        record_atm_fetch(engine, atm_src, atm_id,
+                         fetched_from = min(range_min for range_min, _ in fetch_ranges),
+                         fetched_until = max(range_max for _, range_max in fetch_ranges),
+                         tail_fetched_at = now if needs_tail else None)
+
+    return rows_written
+
+
+##################
+# Main functions #
+##################
+
+def interpolate_atm_data_from_grid(x, engine, debug = True):
+    """Attach atm pressure to sensor observations using the per-station grid
+
+    Drop-in replacement for `interpolate_atm_data`. Observations outside of the available
+    atm pressure record are filtered out.
+
+    Args:
+        x (pd.DataFrame): Sensor observations matched to surveys
+        engine (sqlalchemy.engine.Engine): Database engine
+        debug (bool): Print a summary for each station
+
+    Returns:
+        pd.DataFrame: `x` with a `pressure_mb` column
+    """
+    stations = x.loc[:, ["atm_data_src", "atm_station_id"]].dropna().drop_duplicates()
+
+    interpolated_data = []
+
+    for atm_src, atm_id in stations.itertuples(index = False):
+        selected_data = x[(x["atm_data_src"] == atm_src) & (x["atm_station_id"] == atm_id)].copy()
+
+        dt_min = selected_data["date"].min() - datetime.timedelta(seconds = 1800)
+        dt_max = selected_data["date"].max() + datetime.timedelta(seconds = 1800)
+
+        rows_written = update_atm_grid(engine, atm_src, atm_id, dt_min, dt_max)
+        grid = read_atm_grid(engine, atm_src, atm_id, dt_min, dt_max)
+
+        if grid.values.size == 0:
+            warnings.warn(message = f"No atm pressure data available for: {atm_src} {atm_id}")
+
+        selected_data["pressure_mb"] = grid.lookup(selected_data["date"])
+        matched_data = selected_data[selected_data["pressure_mb"].notna()]
+
+        interpolated_data.append(matched_data)
+
+        if debug == True:
+            print("####################################")
+            print(f"- New raw data detected for atm station: {atm_src} {atm_id}")
+            print("- " , selected_data.shape[0] , " new rows")
+            print("- " , rows_written, " atm grid rows written")
+            print("- " , selected_data.shape[0] - matched_data.shape[0], "new observation(s) filtered out b/c not within atm pressure date range")
+            print("####################################")
+
+    if len(interpolated_data) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(interpolated_data)
@@ -0,0 +1,107 @@
+"""Typed parsers for the NOAA, ISU and FIMAN atm pressure responses
+
+Each parser returns the frame the fetchers have always returned (`id`, `date`, `pressure_mb`,
+`notes`), but with UTC dates parsed using the fixed format of each service and float pressures.
+
+- NOAA: JSON, only the time and value of each observation are read
+- ISU: comma CSV read straight from the response stream, only the `valid` and `alti` columns
+- FIMAN: onerain XML read incrementally with iterparse, one <row> at a time
+
+`bench_atm_parsers.py` compares these against the original parsing code.
+"""
+
+import json
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+import pandas as pd
+
+FIMAN_GAUGE_KEY_PATH = "data/fiman_gauge_key.csv"
+
+NOAA_DATE_FORMAT = "%Y-%m-%d %H:%M"
+ISU_DATE_FORMAT = "%Y-%m-%d %H:%M"
+FIMAN_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# ISU reports altimeter settings in inHg
+INHG_TO_MB = 1000 * 0.0338639
+
+
+def atm_frame(id, dates, pressure_mb, notes):
+    return pd.DataFrame({"id": str(id), "date": dates, "pressure_mb": pressure_mb, "notes": notes})
+
+
+def parse_noaa(content, id):
+    """Parse a NOAA tides and currents `air_pressure` JSON response
+
+    Args:
+        content (bytes): Response body
+        id (str): Station id
+
+    Returns:
+        pd.DataFrame: Atmospheric pressure with dates in UTC
+    """
+    data = json.loads(content)["data"]
+
+    dates = pd.to_datetime([row["t"] for row in data], format = NOAA_DATE_FORMAT, utc = True)
+    pressure_mb = pd.to_numeric(pd.Series([row["v"] for row in data], dtype = object), errors = "coerce").to_numpy(dtype = float)
+
+    return atm_frame(id, dates, pressure_mb, "coop")
+
+
+def parse_isu(stream, id):
+    """Parse an ISU ASOS comma-separated response
+
+    Args:
+        stream (file-like): Response body. Read in chunks by the CSV parser, so a raw HTTP stream works
+        id (str): Station id
+
+    Returns:
+        pd.DataFrame: Atmospheric pressure with dates in UTC
+    """
+    r_df = pd.read_csv(stream, comment = "#", usecols = ["valid", "alti"], dtype = {"valid": str, "alti": float},
+                       na_values = ["", "M"], keep_default_na = False)
+
+    dates = pd.to_datetime(r_df["valid"], format = ISU_DATE_FORMAT, utc = True)
+
+    return atm_frame(id, dates, r_df["alti"] * INHG_TO_MB, "ISU")
+
+
+def parse_fiman(stream, id):
+    """Parse a FIMAN onerain XML response
+
+    Args:
+        stream (file-like): Response body
+        id (str): Station id
+
+    Returns:
+        pd.DataFrame: Atmospheric pressure with dates in UTC
+    """
+    dates = []
+    values = []
+
+    for _, elem in ET.iterparse(stream, events = ("end",)):
+        if elem.tag == "row":
+            dates.append(elem.findtext("data_time"))
+            values.append(elem.findtext("data_value"))
+            elem.clear()
+
+    dates = pd.to_datetime(dates, format = FIMAN_DATE_FORMAT, utc = True)
+    pressure_mb = pd.to_numeric(pd.Series(values, dtype = object), errors = "coerce").to_numpy(dtype = float)
+
+    return atm_frame(id, dates, pressure_mb, "FIMAN")
+
+
+@lru_cache(maxsize = None)
+def read_fiman_gauge_keys(path = FIMAN_GAUGE_KEY_PATH):
+    return pd.read_csv(path)
+
+
+@lru_cache(maxsize = None)
+def fiman_gauge_key(id, path = FIMAN_GAUGE_KEY_PATH):
+    """FIMAN site and sensor ids of the barometric pressure gauge at a station
+
+    Returns:
+        tuple: (site_id, sensor_id)
+    """
+    keys = read_fiman_gauge_keys(path).query("site_id == @id & Sensor == 'Barometric Pressure'")
+
+    return keys.iloc[0]["site_id"], keys.iloc[0]["sensor_id"]
@@ -4,12 +4,12 @@ from pytz import timezone
 import requests
 import datetime
 import pandas as pd
-from io import StringIO
 from urllib.request import urlopen
-import xmltodict
 import numpy as np
 import warnings
 
+from atm_parsers import fiman_gauge_key, parse_fiman, parse_isu, parse_noaa
+
 
 ########################
 # Utility functions    #
@@ -75,17 +75,10 @@ def get_noaa_atm(id, begin_date, end_date):
              'format' : 'json',
              'application' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'}
     
-    r = requests.get('https://api.tidesandcurrents.noaa.gov/api/prod/datagetter/', params=query)
-    
-    j = r.json()
-    
-    r_df = pd.DataFrame.from_dict(j["data"])
+    r = requests.get(os.environ.get("NOAA_URL", 'https://api.tidesandcurrents.noaa.gov/api/prod/datagetter/'), params=query)
+    r.raise_for_status()
     
-    r_df["t"] = pd.to_datetime(r_df["t"], utc=True); r_df["id"] = str(id); r_df["notes"] = "coop"
-    
-    r_df = r_df.loc[:,["id","t","v","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
-    
-    return r_df
+    return parse_noaa(r.content, id)
     
 def get_nws_atm(id, begin_date, end_date):
     """Retrieve atmospheric pressure data from the NWS API
@@ -130,7 +123,7 @@ def get_isu_atm(id, begin_date, end_date):
     new_end_date = pd.to_datetime(end_date, utc=True) 
     
     query = {'station' : str(id),
-             'data' : 'all',
+             'data' : 'alti',
              'year1' : new_begin_date.year,
              'month1' : new_begin_date.month,
              'day1' : new_begin_date.day,
@@ -139,21 +132,15 @@ def get_isu_atm(id, begin_date, end_date):
              'day2' : new_end_date.day + 1,
              'product' : 'air_pressure',
              'format' : 'comma',
-             'latlon' : 'yes'
+             'latlon' : 'no'
              }
     
-    r = requests.get(url = 'https://mesonet.agron.iastate.edu/cgi-bin/request/asos.py', params=query, headers={'User-Agent' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'})
-    
-    s = slicer(str(r.content, 'utf-8'), "station")
-    data = StringIO(s)
-    
-    r_df = pd.read_csv(filepath_or_buffer=data, lineterminator="\n", na_values=["","NA","M"])
+    r = requests.get(url = os.environ.get("ISU_URL", 'https://mesonet.agron.iastate.edu/cgi-bin/request/asos.py'), params=query, headers={'User-Agent' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'}, stream=True)
+    r.raise_for_status()
+    r.raw.decode_content = True
     
-    r_df["date"] = pd.to_datetime(r_df["valid"], utc=True); r_df["id"] = str(id); r_df["notes"] = "ISU"; r_df["pressure_mb"] = r_df["alti"] * 1000 * 0.0338639
-    
-    r_df = r_df.loc[:,["id","date","pressure_mb","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
-    
-    return r_df
+    with r:
+        return parse_isu(r.raw, id)
 
 def get_fiman_atm(id, begin_date, end_date):
     """Retrieve atmospheric pressure data from the NOAA tides and currents API
@@ -167,35 +154,26 @@ def get_fiman_atm(id, begin_date, end_date):
         r_df (pd.DataFrame): DataFrame of atmospheric pressure from specified station and time range. Dates in UTC
     """    
     
-    fiman_gauge_keys = pd.read_csv("data/fiman_gauge_key.csv").query("site_id == @id & Sensor == 'Barometric Pressure'")
+    site_id, sensor_id = fiman_gauge_key(id)
     
     new_begin_date = pd.to_datetime(begin_date, utc=True) - datetime.timedelta(seconds = 3600)
     new_end_date = pd.to_datetime(end_date, utc=True) + datetime.timedelta(seconds = 3600)
     
-    query = {'site_id' : fiman_gauge_keys.iloc[0]["site_id"],
+    query = {'site_id' : site_id,
              'data_start' : new_begin_date.strftime('%Y-%m-%d %H:%M:%S'),
              'end_date' : new_end_date.strftime('%Y-%m-%d %H:%M:%S'),
              'format_datetime' : '%Y-%m-%d %H:%M:%S',
              'tz' : 'utc',
              'show_raw' : True,
              'show_quality' : True,
-             'sensor_id' : fiman_gauge_keys.iloc[0]["sensor_id"]}
-    
-    r = requests.get(os.environ.get("FIMAN_URL"), params=query)
-    
-    j = r.content
-    
-    doc = xmltodict.parse(j)
-    
-    unnested = doc["onerain"]["response"]["general"]["row"]
-    
-    r_df = pd.DataFrame.from_dict(unnested)
-
-    r_df["date"] = pd.to_datetime(r_df["data_time"], utc=True); r_df["id"] = str(id); r_df["notes"] = "FIMAN"
+             'sensor_id' : sensor_id}
     
-    r_df = r_df.loc[:,["id","date","data_value","notes"]].rename(columns = {"data_value":"pressure_mb"})
+    r = requests.get(os.environ.get("FIMAN_URL"), params=query, stream=True)
+    r.raise_for_status()
+    r.raw.decode_content = True
     
-    return r_df
+    with r:
+        return parse_fiman(r.raw, id)
 
 ##################
 # Main functions #
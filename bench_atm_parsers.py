@@ -0,0 +1,144 @@
+"""Micro-benchmark of the atm pressure response parsers
+
+Times the parsers in `atm_parsers.py` against the parsing code the fetchers used before, on
+synthetic payloads from the load test stand-ins or on recorded responses, and checks that both
+produce the same observations.
+
+Usage:
+    python bench_atm_parsers.py --days 30
+    python bench_atm_parsers.py --recorded-dir recorded_responses --repeat 20
+"""
+
+import argparse
+import os
+import timeit
+from io import BytesIO, StringIO
+import numpy as np
+import pandas as pd
+
+from atm_parsers import parse_fiman, parse_isu, parse_noaa
+from load_test import ISU_COLUMNS, OBSERVATION_INTERVAL, fiman_payload, isu_payload, noaa_payload
+
+STATION_ID = "8656483"
+
+
+########################
+# Original parsing     #
+########################
+
+def legacy_parse_noaa(content, id):
+    import json
+
+    r_df = pd.DataFrame.from_dict(json.loads(content)["data"])
+    r_df["t"] = pd.to_datetime(r_df["t"], utc=True); r_df["id"] = str(id); r_df["notes"] = "coop"
+
+    return r_df.loc[:,["id","t","v","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
+
+
+def legacy_parse_isu(content, id):
+    s = str(content, 'utf-8')
+    s = s[s.find("station"):]
+
+    r_df = pd.read_csv(filepath_or_buffer=StringIO(s), lineterminator="\n", na_values=["","NA","M"])
+    r_df["date"] = pd.to_datetime(r_df["valid"], utc=True); r_df["id"] = str(id); r_df["notes"] = "ISU"; r_df["pressure_mb"] = r_df["alti"] * 1000 * 0.0338639
+
+    return r_df.loc[:,["id","date","pressure_mb","notes"]]
+
+
+def legacy_parse_fiman(content, id):
+    import xmltodict
+
+    r_df = pd.DataFrame.from_dict(xmltodict.parse(content)["onerain"]["response"]["general"]["row"])
+    r_df["date"] = pd.to_datetime(r_df["data_time"], utc=True); r_df["id"] = str(id); r_df["notes"] = "FIMAN"
+
+    return r_df.loc[:,["id","date","data_value","notes"]].rename(columns = {"data_value":"pressure_mb"})
+
+
+########################
+# Benchmark            #
+########################
+
+def synthetic_payloads(days):
+    """Payloads as each service would return them for `days` of observations"""
+    end_date = pd.Timestamp.now(tz = "UTC").floor("1D")
+    begin_date = end_date - pd.Timedelta(days = days)
+
+    def dates(source):
+        return pd.date_range(begin_date, end_date, freq = OBSERVATION_INTERVAL[source])
+
+    return {"NOAA": (noaa_payload(STATION_ID, dates("NOAA")), None),
+            # The original fetcher asked ISU for every variable, the new one only for `alti`
+            "ISU": (isu_payload(STATION_ID, dates("ISU"), ISU_COLUMNS), isu_payload(STATION_ID, dates("ISU"), ["station", "valid", "alti"])),
+            "FIMAN": (fiman_payload(STATION_ID, "1", dates("FIMAN")), None)}
+
+
+def recorded_payloads(recorded_dir):
+    payloads = {}
+
+    for source, file_name in [("NOAA", "noaa.json"), ("ISU", "isu.csv"), ("FIMAN", "fiman.xml")]:
+        path = os.path.join(recorded_dir, file_name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                payloads[source] = (f.read(), None)
+
+    return payloads
+
+
+def same_observations(legacy, new):
+    legacy_dates = pd.to_datetime(legacy["date"], utc = True).to_numpy()
+    legacy_pressure = pd.to_numeric(legacy["pressure_mb"], errors = "coerce").to_numpy(dtype = float)
+
+    return (legacy.shape[0] == new.shape[0]
+            and (legacy_dates == new["date"].to_numpy()).all()
+            and np.allclose(legacy_pressure, new["pressure_mb"].to_numpy(dtype = float), equal_nan = True))
+
+
+def time_parser(parse, payload, repeat):
+    """Best time of `repeat` runs, in seconds"""
+    return min(timeit.repeat(lambda: parse(BytesIO(payload), STATION_ID), number = 1, repeat = repeat))
+
+
+def run_benchmark(payloads, repeat):
+    legacy_parsers = {"NOAA": legacy_parse_noaa, "ISU": legacy_parse_isu, "FIMAN": legacy_parse_fiman}
+    new_parsers = {"NOAA": lambda stream, id: parse_noaa(stream.read(), id), "ISU": parse_isu, "FIMAN": parse_fiman}
+
+    results = []
+
+    for source, (legacy_payload, new_payload) in payloads.items():
+        new_payload = legacy_payload if new_payload is None else new_payload
+        legacy_parse = lambda stream, id: legacy_parsers[source](stream.read(), id)
+
+        legacy = legacy_parse(BytesIO(legacy_payload), STATION_ID)
+        new = new_parsers[source](BytesIO(new_payload), STATION_ID)
+
+        legacy_seconds = time_parser(legacy_parse, legacy_payload, repeat)
+        new_seconds = time_parser(new_parsers[source], new_payload, repeat)
+
+        results.append({"source": source,
+                        "rows": new.shape[0],
+                        "legacy_kb": len(legacy_payload) / 1024,
+                        "new_kb": len(new_payload) / 1024,
+                        "legacy_ms": legacy_seconds * 1000,
+                        "new_ms": new_seconds * 1000,
+                        "speedup": legacy_seconds / new_seconds,
+                        "same_output": same_observations(legacy, new)})
+
+    return pd.DataFrame(results)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Compare the atm pressure response parsers against the original parsing code")
+    parser.add_argument("--days", type = int, default = 30, help = "Days of synthetic observations per payload")
+    parser.add_argument("--recorded-dir", help = "Use noaa.json, isu.csv and fiman.xml from this directory instead of synthetic payloads")
+    parser.add_argument("--repeat", type = int, default = 10, help = "Runs per parser; the best time is reported")
+    args = parser.parse_args()
+
+    payloads = recorded_payloads(args.recorded_dir) if args.recorded_dir is not None else synthetic_payloads(args.days)
+
+    results = run_benchmark(payloads, args.repeat)
+
+    print(results.to_string(index = False, float_format = lambda v: f"{v:.2f}"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Check that the batched baseline engine matches the original per-segment implementation
+
+Builds synthetic water depth for several sensors with more than one survey each, runs the
+original `calc_baseline_wl` (kept below as the reference) and `calc_baseline_wl_batched`, and
+compares `smooth_min_wd` row by row for every segment with change points. Exits with status 1 if
+they differ or if no segment went through the LOWESS path (three or more change points).
+
+Needs the pandas pinned in requirements.txt (1.4.2): under pandas 1.5 `match_measurements_to_survey`
+fails to merge its categorical survey bins with the datetime `date_surveyed` of the surveys.
+
+Usage:
+    python check_baseline_engines.py --sensors 6 --days 20
+"""
+
+import argparse
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+from drift_correction import calc_baseline_wl_batched, find_segment_change_points, match_measurements_to_survey
+from synthetic_series import synthetic_water_depth
+
+
+########################
+# Original engine      #
+########################
+
+def legacy_calc_baseline_wl(x, surveys):
+    sensor_list = list(x["sensor_ID"].unique())
+    
+    smoothed_baseline_wl = pd.DataFrame()
+
+    for selected_sensor in sensor_list:
+        selected_data = x.query("sensor_ID == @selected_sensor")
+        selected_survey = surveys.query("sensor_ID == @selected_sensor")
+        
+        if selected_data.shape[0] == 0:
+            warnings.warn(f"No data for sensor for baseline calculation for: {selected_sensor}")     
+        
+        if selected_survey.shape[0] == 0:
+            warnings.warn(f"No survey data for: {selected_sensor}")
+            
+        merged_data = match_measurements_to_survey(measurements = selected_data, surveys = selected_survey)
+        merged_data_w_smoothed_baseline_wl = legacy_smooth_baseline_wl(merged_data)
+        
+        smoothed_baseline_wl = pd.concat([smoothed_baseline_wl, merged_data_w_smoothed_baseline_wl])
+            
+    return smoothed_baseline_wl
+
+
+def legacy_smooth_baseline_wl(x):
+    survey_dates = list(x["date_surveyed"].unique())
+    
+    smoothed_baseline_wl = pd.DataFrame()
+    
+    for selected_survey in survey_dates:
+        selected_data = x.query("date_surveyed == @selected_survey")
+    
+        rolling_min = selected_data.set_index("date")["sensor_water_depth"].rolling('2d').min().reset_index()
+        rolling_min.rename(columns={'sensor_water_depth':'rolling_min_wd'}, inplace = True)
+        rolling_min["lag_min_wd"] = rolling_min["rolling_min_wd"] - rolling_min["rolling_min_wd"].shift(1)
+        rolling_min["lag_duration_minutes"] = (rolling_min["date"] - rolling_min["date"].shift(1)).dt.total_seconds() / 60
+        rolling_min["lag_min_wd_per_minute"] = rolling_min["lag_min_wd"]/rolling_min["lag_duration_minutes"]
+        rolling_min["change_pt"] = np.select(condlist=[rolling_min["lag_min_wd_per_minute"] != 0, rolling_min["date"] == rolling_min["date"].max(), rolling_min["lag_min_wd_per_minute"] == 0], choicelist= [True, True, False], default=False)
+        
+        lower_quantile = np.quantile(rolling_min["rolling_min_wd"], 0.01)
+        upper_quantile = np.quantile(rolling_min["rolling_min_wd"], 0.75)
+        
+        in_bounds = (rolling_min["rolling_min_wd"] >= lower_quantile) & (rolling_min["rolling_min_wd"] <= upper_quantile)
+        change_pts = rolling_min[(rolling_min["change_pt"] == True) & in_bounds].loc[:,["date","rolling_min_wd"]]
+        
+        if change_pts.empty:
+            merged_data_and_change_pts = selected_data
+            merged_data_and_change_pts["smooth_min_wd"] = rolling_min["rolling_min_wd"]
+                
+        if change_pts.shape[0] < 3:
+            merged_data_and_change_pts = pd.merge(selected_data, change_pts.rename(columns = {"rolling_min_wd":"smooth_min_wd"}), how="left").set_index("date")
+            merged_data_and_change_pts["smooth_min_wd"] = merged_data_and_change_pts["smooth_min_wd"].interpolate(method="pad").interpolate(method="backfill")
+            
+        if change_pts.shape[0] >= 3:
+            x = np.array(change_pts["date"].astype('int'))
+            y = np.array(change_pts["rolling_min_wd"])
+            z = sm.nonparametric.lowess(y, x)
+        
+            smoothed_min_wl = pd.DataFrame(z).rename(columns={0:"date",1:"smooth_min_wd"})
+            smoothed_min_wl["date"] = pd.to_datetime(smoothed_min_wl["date"], utc=True)
+        
+            merged_data_and_change_pts = pd.merge(selected_data, smoothed_min_wl, how="left").set_index("date")
+            merged_data_and_change_pts["smooth_min_wd"] = merged_data_and_change_pts["smooth_min_wd"].interpolate(method="time", limit_direction="both")
+            
+        smoothed_baseline_wl = pd.concat([smoothed_baseline_wl, merged_data_and_change_pts])
+
+    return smoothed_baseline_wl
+
+
+########################
+# Check                #
+########################
+
+def synthetic_data(n_sensors, days, interval_minutes = 6, surveys_per_sensor = 2):
+    """Water depth and surveys for `n_sensors` sensors, each surveyed `surveys_per_sensor` times"""
+    begin_date = pd.Timestamp.now(tz = "UTC").floor("1D") - pd.Timedelta(days = days)
+
+    measurements = []
+    surveys = []
+
+    for i in range(n_sensors):
+        sensor_ID = f"CHECK_{i:02d}"
+        survey_dates = [begin_date + pd.Timedelta(days = days * k / surveys_per_sensor) for k in range(surveys_per_sensor)]
+
+        # Rows exactly on the first survey date fall outside the survey bins of the original engine
+        dates = pd.date_range(begin_date + pd.Timedelta(minutes = interval_minutes), begin_date + pd.Timedelta(days = days), freq = f"{interval_minutes}min")
+
+        measurements.append(pd.DataFrame({"place": "Check", "sensor_ID": sensor_ID, "date": dates,
+                                          "sensor_water_depth": synthetic_water_depth(sensor_ID, dates), "notes": "check"}))
+        surveys.append(pd.DataFrame({"place": "Check", "sensor_ID": sensor_ID, "date_surveyed": survey_dates, "notes": "check"}))
+
+    return pd.concat(measurements, ignore_index = True), pd.concat(surveys, ignore_index = True)
+
+
+def same_baseline(legacy, batched, segments, atol = 1e-9):
+    """Compare `smooth_min_wd` of both engines on (sensor_ID, date), within the given segments
+
+    Args:
+        legacy (pd.DataFrame): Output of `legacy_calc_baseline_wl`
+        batched (pd.DataFrame): Output of `calc_baseline_wl_batched`
+        segments (pd.DataFrame): (sensor_ID, date_surveyed) pairs to compare
+
+    Returns:
+        tuple: Whether all rows match (bool), number of compared rows (int), largest difference (float)
+    """
+    keys = ["sensor_ID", "date"]
+    segments = segments.assign(date_surveyed = pd.to_datetime(segments["date_surveyed"], utc = True))
+
+    selected = []
+    for df in [legacy, batched]:
+        df = df.reset_index().loc[:, ["sensor_ID", "date_surveyed", "date", "smooth_min_wd"]]
+        df["date"] = pd.to_datetime(df["date"], utc = True)
+        df["date_surveyed"] = pd.to_datetime(df["date_surveyed"], utc = True)
+        selected.append(df.merge(segments, on = ["sensor_ID", "date_surveyed"]).drop(columns = "date_surveyed"))
+
+    compared = selected[0].merge(selected[1], on = keys, how = "outer", suffixes = ("_legacy", "_batched"), indicator = True)
+    both = compared["_merge"] == "both"
+
+    difference = np.abs(compared.loc[both, "smooth_min_wd_legacy"] - compared.loc[both, "smooth_min_wd_batched"]).max()
+    matches = bool(both.all()) and np.allclose(compared["smooth_min_wd_legacy"], compared["smooth_min_wd_batched"], atol = atol, rtol = 0, equal_nan = True)
+
+    return matches, compared.shape[0], difference
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Compare the batched baseline engine against the original per-segment implementation")
+    parser.add_argument("--sensors", type = int, default = 6, help = "Synthetic sensors")
+    parser.add_argument("--days", type = int, default = 20, help = "Days of water depth per sensor")
+    parser.add_argument("--surveys", type = int, default = 2, help = "Surveys per sensor")
+    args = parser.parse_args()
+
+    measurements, surveys = synthetic_data(args.sensors, args.days, surveys_per_sensor = args.surveys)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        legacy = legacy_calc_baseline_wl(measurements, surveys)
+        batched = calc_baseline_wl_batched(measurements, surveys)
+        matched = pd.concat([match_measurements_to_survey(measurements.query("sensor_ID == @s"), surveys.query("sensor_ID == @s")) for s in surveys["sensor_ID"].unique()])
+
+    change_pts = find_segment_change_points(matched).groupby(["sensor_ID", "date_surveyed"])["change_pt"].sum().rename("n_change_pts").reset_index()
+    lowess_segments = int((change_pts["n_change_pts"] >= 3).sum())
+
+    # Segments without change points are not compared: the original engine assigns the rolling minimum
+    # by index label, which does not line up with the segment's rows, the batched one assigns it by position
+    checked = change_pts.loc[change_pts["n_change_pts"] > 0, ["sensor_ID", "date_surveyed"]]
+
+    matches, rows, difference = same_baseline(legacy, batched, checked)
+
+    print(f"- {rows} rows in {checked.shape[0]} of {change_pts.shape[0]} segments compared, {lowess_segments} through LOWESS, largest difference {difference:.3g} ft")
+
+    if lowess_segments == 0:
+        print("- No segment had three or more change points, the LOWESS path was not checked")
+        sys.exit(1)
+
+    if not matches:
+        print("- The batched engine does not match the original implementation")
+        sys.exit(1)
+
+    print("- The batched engine matches the original implementation")
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,27 @@ import os
 import statsmodels.api as sm
 from sqlalchemy import create_engine
 
+from alerts import alert_settings_from_env, run_alerts
+from memory_budget import chunk_size, report, stage
+from partitions import STREAM_CHUNK_ROWS, read_date_range, write_partitioned
+from rollups import update_rollups
+
 #######################
 # Utility functions   #
 #######################
 
-def get_wd_w_buffer(start_date, end_date, engine):
+def get_wd_w_buffer(start_date, end_date, engine, sensors = None):
     new_start_date = start_date - datetime.timedelta(days = 7)
     
-    try:
-        new_data = pd.read_sql_query(f"SELECT * FROM sensor_water_depth WHERE date >= '{new_start_date}' AND date <= '{end_date}'", engine).sort_values(['place','date']).drop_duplicates()
-    except:
-        new_data = pd.DataFrame()
-        warnings.warn("Connection to database failed to return data")
+    with stage("read sensor_water_depth") as info:
+        try:
+            new_data = read_date_range("sensor_water_depth", engine, new_start_date, end_date, sensors = sensors, chunksize = STREAM_CHUNK_ROWS)
+            new_data = new_data.sort_values(['place','date']).drop_duplicates() if new_data.shape[0] > 0 else new_data
+        except:
+            new_data = pd.DataFrame()
+            warnings.warn("Connection to database failed to return data")
+        
+        info["rows"] = new_data.shape[0]
     
     if new_data.shape[0] == 0:
         warnings.warn("No new data to during requested time period!")
@@ -93,10 +102,15 @@ def match_measurements_to_survey(measurements, surveys):
     return matched_measurements
 
 
-def calc_baseline_wl(x, surveys):
+def calc_baseline_wl_batched(x, surveys, fit_from = None):
+    """Match water depth to surveys and smooth the baseline of every (sensor_ID, date_surveyed) segment in one pass
+
+    `check_baseline_engines.py` compares the result against the original per-segment implementation.
+    See `smooth_baseline_wl_batched` for `fit_from`.
+    """
     sensor_list = list(x["sensor_ID"].unique())
     
-    smoothed_baseline_wl = pd.DataFrame()
+    merged_data = []
 
     for selected_sensor in sensor_list:
         selected_data = x.query("sensor_ID == @selected_sensor")
@@ -108,57 +122,162 @@ def calc_baseline_wl(x, surveys):
         if selected_survey.shape[0] == 0:
             warnings.warn(f"No survey data for: {selected_sensor}")
             
-        merged_data = match_measurements_to_survey(measurements = selected_data, surveys = selected_survey)
-        merged_data_w_smoothed_baseline_wl = smooth_baseline_wl(merged_data)
-        
-        smoothed_baseline_wl = pd.concat([smoothed_baseline_wl, merged_data_w_smoothed_baseline_wl])
+        merged_data.append(match_measurements_to_survey(measurements = selected_data, surveys = selected_survey))
+    
+    if len(merged_data) == 0:
+        return pd.DataFrame()
             
-    return smoothed_baseline_wl
+    return smooth_baseline_wl_batched(pd.concat(merged_data, ignore_index = True), fit_from = fit_from)
+
+
+def grouped_quantile(values, segment, starts, q):
+    """Linear-interpolated quantile of `values` within each contiguous segment, like `np.quantile`
 
+    Args:
+        values (np.ndarray): Values, ordered so that each segment is contiguous
+        segment (np.ndarray): Segment number of each value, ascending
+        starts (np.ndarray): Index of the first value of each segment
+        q (float): Quantile to compute
 
-def smooth_baseline_wl(x):
-    survey_dates = list(x["date_surveyed"].unique())
+    Returns:
+        np.ndarray: Quantile of each segment. NaN for segments that contain NaN
+    """
+    sorted_values = values[np.lexsort((values, segment))]
+    counts = np.diff(np.r_[starts, values.size])
     
-    smoothed_baseline_wl = pd.DataFrame()
+    pos = q * (counts - 1)
+    lower = np.floor(pos).astype(np.int64)
+    upper = np.ceil(pos).astype(np.int64)
     
-    for selected_survey in survey_dates:
-        selected_data = x.query("date_surveyed == @selected_survey")
+    quantiles = sorted_values[starts + lower] + (sorted_values[starts + upper] - sorted_values[starts + lower]) * (pos - lower)
+    quantiles[np.add.reduceat(np.isnan(values), starts) > 0] = np.nan
     
-        rolling_min = selected_data.set_index("date")["sensor_water_depth"].rolling('2d').min().reset_index()
-        rolling_min.rename(columns={'sensor_water_depth':'rolling_min_wd'}, inplace = True)
-        rolling_min["lag_min_wd"] = rolling_min["rolling_min_wd"] - rolling_min["rolling_min_wd"].shift(1)
-        rolling_min["lag_duration_minutes"] = (rolling_min["date"] - rolling_min["date"].shift(1)).dt.total_seconds() / 60
-        rolling_min["lag_min_wd_per_minute"] = rolling_min["lag_min_wd"]/rolling_min["lag_duration_minutes"]
-        rolling_min["change_pt"] = np.select(condlist=[rolling_min["lag_min_wd_per_minute"] != 0, rolling_min["date"] == rolling_min["date"].max(), rolling_min["lag_min_wd_per_minute"] == 0], choicelist= [True, True, False], default=False)
-        
-        lower_quantile = np.quantile(rolling_min["rolling_min_wd"], 0.01)
-        upper_quantile = np.quantile(rolling_min["rolling_min_wd"], 0.75)
-        
-        change_pts = rolling_min.query("change_pt == True & rolling_min_wd >= @lower_quantile & rolling_min_wd <= @upper_quantile ").loc[:,["date","rolling_min_wd"]]        
-        
-        if change_pts.empty:
-            merged_data_and_change_pts = selected_data
-            merged_data_and_change_pts["smooth_min_wd"] = rolling_min["rolling_min_wd"]
-                
-        if change_pts.shape[0] < 3:
-            merged_data_and_change_pts = pd.merge(selected_data, change_pts.rename(columns = {"rolling_min_wd":"smooth_min_wd"}), how="left").set_index("date")
-            merged_data_and_change_pts["smooth_min_wd"] = merged_data_and_change_pts["smooth_min_wd"].interpolate(method="pad").interpolate(method="backfill")
-            
-        if change_pts.shape[0] >= 3:
-            x = np.array(change_pts["date"].astype('int'))
-            y = np.array(change_pts["rolling_min_wd"])
-            b = np.array(change_pts)
-            z = sm.nonparametric.lowess(y, x)
+    return quantiles
+
+
+def find_segment_change_points(x):
+    """Rolling minima and filtered change points for every (sensor_ID, date_surveyed) segment at once
+
+    Args:
+        x (pd.DataFrame): Water depth matched to surveys
+
+    Returns:
+        pd.DataFrame: Rows of `x` with a survey, sorted by segment and date, with `segment`, `rolling_min_wd`,
+            `lower_quantile`, `upper_quantile` and `change_pt` columns
+    """
+    data = x[x["date_surveyed"].notna()].copy()
+    data["segment"] = data.groupby(["sensor_ID", "date_surveyed"], sort = True).ngroup()
+    data = data.sort_values(["segment", "date"], kind = "mergesort").reset_index(drop = True)
+    
+    if data.shape[0] == 0:
+        return data.assign(rolling_min_wd = np.nan, lower_quantile = np.nan, upper_quantile = np.nan, change_pt = False)
+    
+    segment = data["segment"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]])
+    first_in_segment = np.zeros(segment.size, dtype = bool); first_in_segment[starts] = True
+    
+    date_ns = pd.DatetimeIndex(pd.to_datetime(data["date"], utc = True)).asi8
+    rolling_min_wd = data.set_index("date").groupby("segment")["sensor_water_depth"].rolling('2d').min().to_numpy()
+    
+    lag_min_wd = np.r_[np.nan, np.diff(rolling_min_wd)]
+    lag_duration_minutes = np.r_[np.nan, np.diff(date_ns) / 6e10]
+    lag_min_wd[first_in_segment] = np.nan; lag_duration_minutes[first_in_segment] = np.nan
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        lag_min_wd_per_minute = lag_min_wd / lag_duration_minutes
+    
+    is_last_date = date_ns == np.maximum.reduceat(date_ns, starts)[segment]
+    
+    lower_quantile = grouped_quantile(rolling_min_wd, segment, starts, 0.01)[segment]
+    upper_quantile = grouped_quantile(rolling_min_wd, segment, starts, 0.75)[segment]
+    
+    data["rolling_min_wd"] = rolling_min_wd
+    data["lower_quantile"] = lower_quantile
+    data["upper_quantile"] = upper_quantile
+    data["change_pt"] = ((lag_min_wd_per_minute != 0) | is_last_date) & (rolling_min_wd >= lower_quantile) & (rolling_min_wd <= upper_quantile)
+    
+    return data
+
+
+def fill_from_change_pts(values, change_pt, segment_start, segment_end):
+    """Pad, then backfill, the change point values within each segment"""
+    idx = np.arange(values.size)
+    
+    last_change_pt = np.maximum.accumulate(np.where(change_pt, idx, -1))
+    next_change_pt = np.minimum.accumulate(np.where(change_pt, idx, values.size)[::-1])[::-1]
+    
+    has_last = last_change_pt >= segment_start
+    has_next = next_change_pt < segment_end
+    
+    padded = values[np.clip(last_change_pt, 0, values.size - 1)]
+    backfilled = values[np.clip(next_change_pt, 0, values.size - 1)]
+    
+    return np.where(has_last, padded, np.where(has_next, backfilled, np.nan))
+
+
+def smooth_baseline_wl_batched(x, fit_from = None):
+    """Smoothed baseline water depth for every (sensor_ID, date_surveyed) segment
+
+    Rolling minima, change points and quantile bounds are computed for all segments with grouped
+    array operations. Only the LOWESS fit runs per segment.
+
+    Segments without change points use the rolling minimum, segments with one or two change points
+    pad and backfill them, and segments with three or more use a LOWESS fit through the change points
+    interpolated in time. Rows without a survey are dropped.
+
+    The rolling minimum for segments without change points differs from the original per-segment
+    engine, which assigned it by index label to rows it did not line up with, leaving them (nearly
+    always) NaN. Those rows now get a baseline and so real values in `data_for_display`.
+
+    With `fit_from`, segments whose last row is older than it are not fitted and get NaN: their rows
+    only serve as the lookback buffer and are dropped by `correct_drift`.
+
+    Args:
+        x (pd.DataFrame): Water depth matched to surveys
+        fit_from (datetime): Skip the LOWESS fit of segments ending before this date. Default: fit all
+
+    Returns:
+        pd.DataFrame: `x` with a `smooth_min_wd` column, indexed by date
+    """
+    data = find_segment_change_points(x)
+    
+    if data.shape[0] == 0:
+        return data.assign(smooth_min_wd = np.nan).drop(columns = ["segment", "rolling_min_wd", "lower_quantile", "upper_quantile", "change_pt"]).set_index("date")
+    
+    segment = data["segment"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]])
+    ends = np.r_[starts[1:], segment.size]
+    
+    date_ns = pd.DatetimeIndex(pd.to_datetime(data["date"], utc = True)).asi8
+    rolling_min_wd = data["rolling_min_wd"].to_numpy()
+    change_pt = data["change_pt"].to_numpy()
+    
+    segment_change_pts = np.bincount(segment[change_pt], minlength = starts.size)
+    n_change_pts = segment_change_pts[segment]
+    
+    filled = fill_from_change_pts(rolling_min_wd, change_pt, starts[segment], ends[segment])
+    # No change points: the rolling minimum itself. The original engine left these rows NaN in data_for_display
+    smooth_min_wd = np.select(condlist = [n_change_pts == 0, n_change_pts < 3], choicelist = [rolling_min_wd, filled], default = np.nan)
+    
+    fitted_segments = np.flatnonzero(segment_change_pts >= 3)
+    
+    if fit_from is not None:
+        segment_last_date = np.maximum.reduceat(date_ns, starts)
+        fitted_segments = fitted_segments[segment_last_date[fitted_segments] >= pd.to_datetime(fit_from, utc = True).value]
+    
+    for selected_segment in fitted_segments:
+        rows = slice(starts[selected_segment], ends[selected_segment])
+        selected_change_pts = change_pt[rows]
         
-            smoothed_min_wl = pd.DataFrame(z).rename(columns={0:"date",1:"smooth_min_wd"})
-            smoothed_min_wl["date"] = pd.to_datetime(smoothed_min_wl["date"], utc=True)
+        change_pt_dates = date_ns[rows][selected_change_pts]
+        fitted = sm.nonparametric.lowess(rolling_min_wd[rows][selected_change_pts], change_pt_dates, return_sorted = False)
         
-            merged_data_and_change_pts = pd.merge(selected_data, smoothed_min_wl, how="left").set_index("date")
-            merged_data_and_change_pts["smooth_min_wd"] = merged_data_and_change_pts["smooth_min_wd"].interpolate(method="time", limit_direction="both")
-            
-        smoothed_baseline_wl = pd.concat([smoothed_baseline_wl, merged_data_and_change_pts])
+        smooth_min_wd[rows] = np.interp(date_ns[rows], change_pt_dates, fitted)
+    
+    data["smooth_min_wd"] = smooth_min_wd
+    
+    return data.drop(columns = ["segment", "rolling_min_wd", "lower_quantile", "upper_quantile", "change_pt"]).set_index("date")
 
-    return smoothed_baseline_wl
 
 def correct_drift(x, start_date, end_date):
     data = x.copy().reset_index()
@@ -189,7 +308,147 @@ def postgres_upsert(table, conn, keys, data_iter):
         set_={c.key: c for c in insert_statement.excluded},
     )
     conn.execute(upsert_statement)
+
+
+def normalize_for_hash(values, like, decimals = 6):
+    """Convert a column to a canonical form so values hash the same before and after a database round trip
+
+    Args:
+        values (pd.Series): Column to convert
+        like (pd.Series): Column whose dtype decides the conversion. Usually the freshly computed column
+        decimals (int): Floats are rounded to this many decimals
+
+    Returns:
+        pd.Series: Canonical values
+    """
+    if pd.api.types.is_datetime64_any_dtype(like):
+        return pd.Series(pd.DatetimeIndex(pd.to_datetime(values, utc = True)).asi8, index = values.index)
+    
+    if pd.api.types.is_numeric_dtype(like) or pd.api.types.is_bool_dtype(like):
+        return pd.to_numeric(values, errors = "coerce").astype(float).round(decimals)
+    
+    return values.astype(object).where(values.notna(), None).astype(str)
+
+
+def row_hashes(x, like, value_cols):
+    normalized = pd.DataFrame({col: normalize_for_hash(x[col], like[col]) for col in value_cols}, index = x.index)
+    
+    return pd.util.hash_pandas_object(normalized, index = False)
+
+
+def get_existing_rows(table, engine, x, columns):
+    """Read the rows of `table` that share a sensor and date range with `x`"""
+    return read_date_range(table, engine, x["date"].min(), x["date"].max(), columns = columns, sensors = x["sensor_ID"].unique())
+
+
+def split_changed_rows(x, existing, key_cols, value_cols):
+    """Compare new rows against existing rows by a per-row hash of their values
+
+    Args:
+        x (pd.DataFrame): New rows, with key columns as columns
+        existing (pd.DataFrame): Rows currently in the database
+        key_cols (list): Columns that identify a row
+        value_cols (list): Columns compared between the new and existing rows
+
+    Returns:
+        tuple: Rows to insert (pd.DataFrame), rows to update (pd.DataFrame), number of unchanged rows (int)
+    """
+    new_keys = x.loc[:, key_cols].copy()
+    new_keys["date"] = pd.to_datetime(new_keys["date"], utc = True)
+    new_keys["new_hash"] = row_hashes(x, x, value_cols).to_numpy()
+    
+    existing_keys = existing.loc[:, key_cols].copy()
+    existing_keys["date"] = pd.to_datetime(existing_keys["date"], utc = True)
+    existing_keys["existing_hash"] = row_hashes(existing, x, value_cols).to_numpy()
+    existing_keys = existing_keys.drop_duplicates(subset = key_cols)
+    
+    compared = new_keys.merge(existing_keys, on = key_cols, how = "left")
+    
+    is_new = compared["existing_hash"].isna().to_numpy()
+    is_changed = ~is_new & (compared["new_hash"] != compared["existing_hash"]).to_numpy()
+    
+    return x[is_new], x[is_changed], int((~is_new & ~is_changed).sum())
+
+
+def write_changed_rows(x, table, engine, chunksize = 3000):
+    """Upsert only the rows of `x` that are new or differ from what is already in `table`
+
+    Args:
+        x (pd.DataFrame): Rows indexed by the primary key of `table`
+        table (str): Name of the table to write to
+        engine (sqlalchemy.engine.Engine): Database engine
+        chunksize (int): Number of rows per upsert statement
+
+    Returns:
+        tuple: Inserted rows (pd.DataFrame), updated rows (pd.DataFrame), counts of inserted, updated and skipped rows (dict)
+    """
+    key_cols = list(x.index.names)
+    data = x.reset_index().drop_duplicates(subset = key_cols, keep = "last")
+    value_cols = [col for col in data.columns if col not in key_cols]
+    
+    existing = get_existing_rows(table, engine, data, key_cols + value_cols)
+    inserted, updated, skipped = split_changed_rows(data, existing, key_cols, value_cols)
     
+    changed = pd.concat([inserted, updated]).set_index(key_cols)
+    
+    if changed.shape[0] > 0:
+        write_partitioned(changed, table, engine, method = postgres_upsert, chunksize = chunksize)
+    
+    counts = {"inserted": inserted.shape[0], "updated": updated.shape[0], "skipped": skipped}
+    
+    return inserted, updated, counts
+    
+
+def run_drift_correction(engine, sensors = None, days = 7, alert_settings = None):
+    """Drift-correct the last `days` of water depth and write changed rows to `data_for_display`
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        sensors (list): Only correct these sensors. Default: all
+        days (int): Number of days to correct, ending now
+        alert_settings (dict): Keyword arguments for `run_alerts`. Default: its defaults
+
+    Returns:
+        pd.DataFrame: Drift-corrected rows that were inserted or updated
+    """
+    end_date = pd.to_datetime(datetime.datetime.utcnow())
+    start_date = end_date - datetime.timedelta(days=days)
+
+    new_data = get_wd_w_buffer(start_date, end_date, engine, sensors = sensors)
+    surveys = get_surveys(engine)
+    
+    if new_data.shape[0] == 0 or surveys is None:
+        return pd.DataFrame()
+
+    with stage("qa_qc_flag", rows = new_data.shape[0]):
+        qa_qcd_df = qa_qc_flag(new_data).query("qa_qc_flag == False")
+    with stage("calc_baseline_wl", rows = qa_qcd_df.shape[0]):
+        smoothed_min_wl_df = calc_baseline_wl_batched(qa_qcd_df, surveys, fit_from = start_date)
+    with stage("correct_drift", rows = smoothed_min_wl_df.shape[0]):
+        drift_corrected_df = correct_drift(smoothed_min_wl_df, start_date, end_date)
+
+    with stage("alerts", rows = drift_corrected_df.shape[0]):
+        try:
+            run_alerts(drift_corrected_df, engine, **(alert_settings or {}))
+        except Exception as e:
+            warnings.warn(f"Error evaluating alerts: {e}")
+
+    with stage("write data_for_display", rows = drift_corrected_df.shape[0]):
+        try:
+            inserted, updated, counts = write_changed_rows(drift_corrected_df, "data_for_display", engine, chunksize = chunk_size("write data_for_display"))
+            print(f"Drift-corrected data written to database! {counts['inserted']} inserted, {counts['updated']} updated, {counts['skipped']} unchanged rows skipped")
+        except:
+            warnings.warn("Error writing drift-corrected data to database")
+            return pd.DataFrame()
+
+    with stage("update rollups", rows = counts["inserted"] + counts["updated"]):
+        try:
+            update_rollups(engine, inserted, updated)
+        except:
+            warnings.warn("Error updating data_for_display rollups, rebuild them with `python rollups.py rebuild`")
+    
+    return pd.concat([inserted, updated])
+
 
 def main():
 
@@ -206,23 +465,11 @@ def main():
     # Process data  #
     #####################
 
-    end_date = pd.to_datetime(datetime.datetime.utcnow())
-    start_date = end_date - datetime.timedelta(days=7)
-
-    new_data = get_wd_w_buffer(start_date, end_date, engine)
-    surveys = get_surveys(engine)
-
-    qa_qcd_df = qa_qc_flag(new_data).query("qa_qc_flag == False")
-    smoothed_min_wl_df = calc_baseline_wl(qa_qcd_df, surveys)
-    drift_corrected_df = correct_drift(smoothed_min_wl_df, start_date, end_date)
-
-    try:
-        drift_corrected_df.to_sql("data_for_display", engine, if_exists = "append", method=postgres_upsert, chunksize = 3000)
-        print("Drift-corrected data written to database!")
-    except:
-        warnings.warn("Error writing drift-corrected data to database")
+    run_drift_correction(engine, alert_settings = alert_settings_from_env())
+    
+    report()
     
     engine.dispose()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,208 @@
+"""Event-driven processing of new sensor data
+
+An insert trigger on `sensor_data` sends a NOTIFY with the (place, sensor_ID) of every new raw row.
+The listener collects notifications over a short window and then runs the process -> drift path for
+just those sensors, so a new water level appears seconds after the raw data lands instead of at the
+next scheduled run. A polling sweep over all unprocessed data still runs at a longer interval to
+catch anything a notification missed (e.g. while the listener was down). If the LISTEN connection
+drops, the listener reconnects with backoff and runs the sweep once right away, since notifications
+sent while it was disconnected are lost.
+
+Usage:
+    python event_listener.py --install-trigger
+    python event_listener.py --window-seconds 5 --sweep-seconds 900
+"""
+
+import argparse
+import json
+import os
+import select
+import time
+import warnings
+import psycopg2
+import psycopg2.extensions
+from sqlalchemy import create_engine
+
+from alerts import alert_settings_from_env
+from drift_correction import run_drift_correction
+from process_pressure import get_new_data, get_surveys, process_new_data
+
+CHANNEL = "sensor_data_inserted"
+
+# Reconnect delays after the LISTEN connection drops, in seconds
+RECONNECT_DELAY = 1
+RECONNECT_DELAY_MAX = 60
+
+CREATE_NOTIFY_TRIGGER = f"""
+CREATE OR REPLACE FUNCTION notify_sensor_data_inserted() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{CHANNEL}', json_build_object('place', NEW.place, 'sensor_ID', NEW."sensor_ID")::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sensor_data_notify ON sensor_data;
+
+CREATE TRIGGER sensor_data_notify
+    AFTER INSERT ON sensor_data
+    FOR EACH ROW
+    WHEN (NEW.processed IS NOT TRUE AND NEW.pressure > 800)
+    EXECUTE FUNCTION notify_sensor_data_inserted();
+"""
+
+
+def install_notify_trigger(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_NOTIFY_TRIGGER)
+
+
+def process_partitions(engine, partitions = None, alert_settings = None):
+    """Run the process -> drift path for some or all (place, sensor_ID) partitions
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        partitions (list): (place, sensor_ID) pairs to process. Default: all unprocessed data
+        alert_settings (dict): Passed on to `run_drift_correction`
+
+    Returns:
+        int: Number of raw rows converted to water depth
+    """
+    new_data = get_new_data(engine, partitions = partitions)
+
+    if new_data.shape[0] == 0:
+        return 0
+
+    surveys = get_surveys(engine)
+
+    if surveys.shape[0] == 0:
+        warnings.warn("- No survey data!")
+        return 0
+
+    formatted_data = process_new_data(new_data, surveys, engine)
+
+    if formatted_data.shape[0] > 0:
+        sensors = list(formatted_data.index.get_level_values("sensor_ID").unique())
+        run_drift_correction(engine, sensors = sensors, alert_settings = alert_settings)
+
+    return formatted_data.shape[0]
+
+
+def connect_listener(engine):
+    """Open an autocommit connection and LISTEN on the notification channel"""
+    conn = psycopg2.connect(engine.url.render_as_string(hide_password = False))
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {CHANNEL}")
+
+    return conn
+
+
+def reconnect_listener(engine):
+    """Reconnect and LISTEN again, retrying with exponential backoff until it succeeds"""
+    delay = RECONNECT_DELAY
+
+    while True:
+        try:
+            return connect_listener(engine)
+        except psycopg2.OperationalError as e:
+            warnings.warn(f"Reconnecting to {CHANNEL} failed, retrying in {delay} s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+
+def listen(engine, window_seconds = 5, sweep_seconds = 900, alert_settings = None):
+    """Process sensors as their notifications arrive, with a periodic polling sweep
+
+    Notifications are micro-batched: the first one opens a window of `window_seconds`, and every
+    sensor notified before the window closes is processed together.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine used for processing
+        window_seconds (float): Length of the micro-batch window
+        sweep_seconds (float): Interval of the polling sweep over all unprocessed data
+        alert_settings (dict): Passed on to `run_drift_correction`
+    """
+    conn = connect_listener(engine)
+
+    print(f"- Listening on {CHANNEL}")
+
+    pending = set()
+    window_closes = None
+    next_sweep = time.monotonic()
+
+    try:
+        while True:
+            now = time.monotonic()
+            deadlines = [next_sweep] + ([window_closes] if window_closes is not None else [])
+            timeout = max(min(deadlines) - now, 0)
+
+            try:
+                if select.select([conn], [], [], timeout) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        try:
+                            payload = json.loads(notification.payload)
+                            pending.add((payload["place"], payload["sensor_ID"]))
+                        except (ValueError, KeyError):
+                            warnings.warn(f"Ignoring malformed notification: {notification.payload}")
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, OSError) as e:
+                warnings.warn(f"Lost the connection listening on {CHANNEL}, reconnecting: {e}")
+                conn.close()
+                conn = reconnect_listener(engine)
+                print(f"- Listening on {CHANNEL} again")
+
+                # Notifications sent while disconnected are gone, so sweep everything now
+                next_sweep = time.monotonic()
+
+            if pending and window_closes is None:
+                window_closes = time.monotonic() + window_seconds
+
+            now = time.monotonic()
+
+            if window_closes is not None and now >= window_closes:
+                batch = sorted(pending)
+                pending.clear(); window_closes = None
+
+                start = time.monotonic()
+                try:
+                    rows = process_partitions(engine, partitions = batch, alert_settings = alert_settings)
+                    print(f"- Processed {rows} new row(s) for {len(batch)} sensor(s) in {time.monotonic() - start:.1f} s")
+                except Exception as e:
+                    warnings.warn(f"Error processing notified sensors, leaving them to the safety sweep: {e}")
+
+            if now >= next_sweep:
+                try:
+                    rows = process_partitions(engine, alert_settings = alert_settings)
+                    print(f"- Safety sweep processed {rows} new row(s)")
+                except Exception as e:
+                    warnings.warn(f"Error during safety sweep: {e}")
+                next_sweep = time.monotonic() + sweep_seconds
+    finally:
+        conn.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Process new sensor data as soon as it is inserted")
+    parser.add_argument("--install-trigger", action = "store_true", help = "Create the NOTIFY trigger on sensor_data and exit")
+    parser.add_argument("--window-seconds", type = float, default = 5, help = "Micro-batch window for notifications")
+    parser.add_argument("--sweep-seconds", type = float, default = 900, help = "Interval of the polling sweep over all unprocessed data")
+    args = parser.parse_args()
+
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+    if args.install_trigger:
+        install_notify_trigger(engine)
+        print(f"- Installed NOTIFY trigger on sensor_data (channel: {CHANNEL})")
+    else:
+        listen(engine, window_seconds = args.window_seconds, sweep_seconds = args.sweep_seconds, alert_settings = alert_settings_from_env())
+
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
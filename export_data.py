@@ -0,0 +1,280 @@
+"""Bulk export of processed water levels to Parquet or gzipped CSV
+
+Rows of `sensor_water_depth` or `data_for_display` for a set of sensors and a date range are
+streamed through a server-side cursor, a chunk at a time, into one file per place, sensor and
+month:
+
+    <out>/<table>/place=<place>/sensor_ID=<sensor_ID>/<table>_<YYYY-MM>.parquet
+
+A manifest in `<out>/<table>/manifest.json` records the row count, latest date and change mark of
+every file. Re-running an export only rewrites files whose month gained rows or was written to since,
+including rows drift correction updated in place. Change marks are stamped by the pipeline's writers
+(`partitions.mark_changed_months`), so checking them costs no scan of the exported rows.
+
+Parquet output needs pyarrow; use `--format csv` without it.
+
+Usage:
+    python export_data.py --table data_for_display --start 2022-01-01 --end 2022-07-01 --out exports
+    python export_data.py --table sensor_water_depth --sensors BF_01 BF_02 --start 2022-01-01 --end 2022-02-01 --format csv
+"""
+
+import argparse
+import gzip
+import json
+import importlib.util
+import os
+import re
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from memory_budget import chunk_size, stage
+from partitions import CHANGE_MARKS_TABLE, iter_sql_chunks, month_starts
+
+EXPORT_TABLES = ["sensor_water_depth", "data_for_display"]
+MANIFEST_NAME = "manifest.json"
+
+# Postgres column types -> pyarrow type names
+ARROW_TYPES = {"double precision": "float64",
+               "real": "float32",
+               "integer": "int64",
+               "bigint": "int64",
+               "boolean": "bool_",
+               "text": "string",
+               "character varying": "string"}
+
+
+########################
+# Utility functions    #
+########################
+
+def path_component(value):
+    """Make a place or sensor name safe to use as a directory name"""
+    return re.sub(r"[^A-Za-z0-9._-]", "_", str(value))
+
+
+def export_path(out_dir, table, place, sensor_ID, month, file_format):
+    extension = "parquet" if file_format == "parquet" else "csv.gz"
+
+    return os.path.join(out_dir, table, f"place={path_component(place)}", f"sensor_ID={path_component(sensor_ID)}", f"{table}_{month:%Y-%m}.{extension}")
+
+
+def read_manifest(out_dir, table):
+    path = os.path.join(out_dir, table, MANIFEST_NAME)
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(out_dir, table, manifest):
+    path = os.path.join(out_dir, table, MANIFEST_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+    os.replace(path + ".tmp", path)
+
+
+def arrow_schema(engine, table):
+    """Parquet schema built from the column types of `table`, so every chunk and file agrees"""
+    import pyarrow as pa
+
+    columns = pd.read_sql_query(text("SELECT column_name, data_type FROM information_schema.columns WHERE table_name = :table ORDER BY ordinal_position"),
+                                engine, params = {"table": table})
+
+    fields = []
+    for column in columns.itertuples():
+        if column.data_type == "timestamp with time zone":
+            arrow_type = pa.timestamp("us", tz = "UTC")
+        elif column.data_type == "timestamp without time zone":
+            arrow_type = pa.timestamp("us")
+        else:
+            arrow_type = getattr(pa, ARROW_TYPES.get(column.data_type, "string"))()
+        fields.append(pa.field(column.column_name, arrow_type))
+
+    return pa.schema(fields)
+
+
+########################
+# Export               #
+########################
+
+def list_export_units(engine, table, start_date, end_date, places = None, sensors = None):
+    """Row count, latest date and change mark of every (place, sensor_ID, month) in the range
+
+    `changed_at` is when a writer last touched the month, or NaT for months written before change
+    marks existed.
+
+    Returns:
+        pd.DataFrame: One row per file to export
+    """
+    query = f"""
+        SELECT place, "sensor_ID", date_trunc('month', date AT TIME ZONE 'UTC') AS month, count(*) AS rows, max(date) AS max_date
+        FROM {table}
+        WHERE date >= :start_date AND date < :end_date
+    """
+    params = {"start_date": start_date, "end_date": end_date}
+
+    if places is not None:
+        query += " AND place = ANY(:places)"
+        params["places"] = list(places)
+    if sensors is not None:
+        query += ' AND "sensor_ID" = ANY(:sensors)'
+        params["sensors"] = list(sensors)
+
+    query += " GROUP BY 1, 2, 3"
+
+    with engine.connect() as conn:
+        has_marks = conn.execute(text("SELECT to_regclass(:table) IS NOT NULL"), {"table": CHANGE_MARKS_TABLE}).scalar()
+
+    if has_marks:
+        query = f"""
+            SELECT u.*, m.changed_at FROM ({query}) u
+            LEFT JOIN {CHANGE_MARKS_TABLE} m ON m.table_name = :table AND m.place = u.place AND m."sensor_ID" = u."sensor_ID" AND m.month = u.month::date
+        """
+        params["table"] = table
+    else:
+        query = f"SELECT u.*, NULL::timestamptz AS changed_at FROM ({query}) u"
+
+    units = pd.read_sql_query(text(query + " ORDER BY 1, 2, 3"), engine, params = params)
+    units["month"] = pd.to_datetime(units["month"]).dt.tz_localize("UTC")
+    units["max_date"] = pd.to_datetime(units["max_date"], utc = True)
+    units["changed_at"] = pd.to_datetime(units["changed_at"], utc = True)
+
+    return units
+
+
+def change_mark(unit):
+    return None if pd.isna(unit.changed_at) else unit.changed_at.isoformat()
+
+
+def is_current(manifest, key, unit, path):
+    entry = manifest.get(key)
+
+    return (entry is not None and os.path.exists(path) and entry["rows"] == unit.rows and entry["max_date"] == unit.max_date.isoformat()
+            and entry.get("changed_at") == change_mark(unit))
+
+
+def write_unit(engine, table, unit, path, file_format, schema = None):
+    """Stream the rows of one (place, sensor_ID, month) into a file
+
+    The file is written under a temporary name and moved into place when complete, so an
+    interrupted export never leaves a truncated file behind.
+
+    Returns:
+        int: Number of rows written
+    """
+    query = text(f"""
+        SELECT * FROM {table}
+        WHERE place = :place AND "sensor_ID" = :sensor_ID AND date >= :start_date AND date < :end_date
+        ORDER BY date
+    """)
+    params = {"place": unit.place, "sensor_ID": unit.sensor_ID,
+              "start_date": unit.month.to_pydatetime(), "end_date": (unit.month + pd.offsets.MonthBegin(1)).to_pydatetime()}
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp_path = path + ".tmp"
+    rows = 0
+
+    if file_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        with pq.ParquetWriter(tmp_path, schema, compression = "snappy") as writer:
+            for chunk in iter_sql_chunks(query, engine, params = params, chunksize = chunk_size("export", default = 50000)):
+                writer.write_table(pa.Table.from_pandas(chunk, schema = schema, preserve_index = False))
+                rows += chunk.shape[0]
+    else:
+        with gzip.open(tmp_path, "wt", newline = "") as f:
+            for chunk in iter_sql_chunks(query, engine, params = params, chunksize = chunk_size("export", default = 50000)):
+                chunk.to_csv(f, header = rows == 0, index = False)
+                rows += chunk.shape[0]
+
+    os.replace(tmp_path, path)
+
+    return rows
+
+
+def export(engine, table, out_dir, start_date, end_date, places = None, sensors = None, file_format = "parquet", force = False):
+    """Export a table to one file per place, sensor and month, skipping files that are up to date
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        table (str): "sensor_water_depth" or "data_for_display"
+        out_dir (str): Output directory
+        start_date (pd.Timestamp): Beginning of the range, inclusive. Widened to the start of its month
+        end_date (pd.Timestamp): End of the range, exclusive. Widened to the end of its month
+        places (list): Only export these places. Default: all
+        sensors (list): Only export these sensors. Default: all
+        file_format (str): "parquet" or "csv"
+        force (bool): Rewrite files even if the manifest says they are up to date
+
+    Returns:
+        dict: Number of files written and skipped, and rows written
+    """
+    schema = arrow_schema(engine, table) if file_format == "parquet" else None
+
+    # Files hold whole months, so widen the range to month boundaries
+    start_date = month_starts([start_date])[0].to_pydatetime()
+    end_date = (month_starts([pd.Timestamp(end_date) - pd.Timedelta("1us")])[0] + pd.offsets.MonthBegin(1)).to_pydatetime()
+
+    units = list_export_units(engine, table, start_date, end_date, places = places, sensors = sensors)
+    manifest = read_manifest(out_dir, table)
+
+    counts = {"written": 0, "skipped": 0, "rows": 0}
+
+    for unit in units.itertuples():
+        path = export_path(out_dir, table, unit.place, unit.sensor_ID, unit.month, file_format)
+        key = os.path.relpath(path, os.path.join(out_dir, table))
+
+        if not force and is_current(manifest, key, unit, path):
+            counts["skipped"] += 1
+            continue
+
+        with stage("export", rows = unit.rows):
+            rows = write_unit(engine, table, unit, path, file_format, schema = schema)
+
+        manifest[key] = {"place": unit.place, "sensor_ID": unit.sensor_ID, "month": f"{unit.month:%Y-%m}",
+                         "rows": rows, "max_date": unit.max_date.isoformat(), "changed_at": change_mark(unit), "exported_at": pd.Timestamp.now(tz = "UTC").isoformat()}
+        # Saved after every file, so an interrupted export resumes where it stopped
+        write_manifest(out_dir, table, manifest)
+
+        counts["written"] += 1
+        counts["rows"] += rows
+
+    return counts
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Export processed water levels to Parquet or gzipped CSV, one file per place, sensor and month")
+    parser.add_argument("--table", choices = EXPORT_TABLES, default = "data_for_display")
+    parser.add_argument("--start", required = True, help = "First date to export (UTC)")
+    parser.add_argument("--end", required = True, help = "Date to export up to, exclusive (UTC)")
+    parser.add_argument("--places", nargs = "+", help = "Only export these places")
+    parser.add_argument("--sensors", nargs = "+", help = "Only export these sensors")
+    parser.add_argument("--format", choices = ["parquet", "csv"], default = "parquet")
+    parser.add_argument("--out", default = "exports", help = "Output directory")
+    parser.add_argument("--force", action = "store_true", help = "Rewrite files that are already up to date")
+    args = parser.parse_args()
+
+    if args.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        parser.error("Parquet export needs pyarrow. Install it or use --format csv")
+
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+    start_date = pd.Timestamp(args.start, tz = "UTC").to_pydatetime()
+    end_date = pd.Timestamp(args.end, tz = "UTC").to_pydatetime()
+
+    counts = export(engine, args.table, args.out, start_date, end_date, places = args.places, sensors = args.sensors, file_format = args.format, force = args.force)
+    print(f"- Exported {counts['rows']} rows of {args.table} to {counts['written']} file(s), {counts['skipped']} file(s) already up to date")
+
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
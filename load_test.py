@@ -0,0 +1,536 @@
+"""End-to-end load test for the pressure and drift correction pipelines
+
+Starts local stand-ins for the NOAA, ISU and FIMAN atm pressure services, seeds a throwaway
+Postgres database with synthetic sensor data and runs `process_pressure.main` followed by
+`drift_correction.main` against it. Reports end-to-end rows/sec and per-stage timings.
+
+Usage:
+    python load_test.py --places 10 --sensors-per-place 4 --days 3
+    python load_test.py --database-url postgresql://postgres@localhost:5432/postgres --latency-ms 200 --error-rate 0.05
+
+Without `--database-url` a temporary Postgres cluster is created with `initdb`/`pg_ctl`, which
+must be on the PATH. With `--database-url` a new database is created on that server and dropped
+afterwards, so existing data is never touched.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+from partitions import PARTITIONED_TABLES, migrate_to_partitioned
+from synthetic_series import synthetic_atm_pressure, synthetic_water_depth
+
+ATM_SOURCES = ["NOAA", "ISU", "FIMAN"]
+
+# Observation spacing of each stand-in, roughly that of the real services
+OBSERVATION_INTERVAL = {"NOAA": pd.Timedelta(minutes = 6), "ISU": pd.Timedelta(minutes = 5), "FIMAN": pd.Timedelta(minutes = 15)}
+
+# Most recent observation each stand-in will serve, relative to now
+REPORTING_LAG = pd.Timedelta(minutes = 10)
+
+ISU_COLUMNS = ["station", "valid", "lon", "lat", "tmpf", "dwpf", "relh", "drct", "sknt", "p01i", "alti", "mslp", "vsby", "gust",
+               "skyc1", "skyc2", "skyc3", "skyc4", "skyl1", "skyl2", "skyl3", "skyl4", "wxcodes", "ice_accretion_1hr",
+               "ice_accretion_3hr", "ice_accretion_6hr", "peak_wind_gust", "peak_wind_drct", "peak_wind_time", "feel", "metar", "snowdepth"]
+
+BASE_SCHEMA = """
+CREATE TABLE sensor_data (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    date timestamptz NOT NULL,
+    pressure double precision,
+    voltage double precision,
+    notes text,
+    processed boolean DEFAULT FALSE,
+    CONSTRAINT sensor_data_pkey PRIMARY KEY (place, "sensor_ID", date)
+);
+
+CREATE TABLE sensor_surveys (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    date_surveyed timestamptz NOT NULL,
+    sensor_elevation double precision,
+    road_elevation double precision,
+    lat double precision,
+    lng double precision,
+    alert_threshold double precision,
+    atm_data_src text,
+    atm_station_id text,
+    notes text,
+    CONSTRAINT sensor_surveys_pkey PRIMARY KEY (place, "sensor_ID", date_surveyed)
+);
+
+CREATE TABLE sensor_water_depth (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    date timestamptz NOT NULL,
+    atm_pressure double precision,
+    sensor_pressure double precision,
+    voltage double precision,
+    notes text,
+    sensor_water_depth double precision,
+    qa_qc_flag boolean,
+    tag text,
+    atm_data_src text,
+    atm_station_id text,
+    CONSTRAINT sensor_water_depth_pkey PRIMARY KEY (place, "sensor_ID", date)
+);
+
+CREATE TABLE data_for_display (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    date timestamptz NOT NULL,
+    voltage double precision,
+    sensor_water_depth double precision,
+    qa_qc_flag boolean,
+    date_surveyed timestamptz,
+    sensor_elevation double precision,
+    road_elevation double precision,
+    lat double precision,
+    lng double precision,
+    alert_threshold double precision,
+    min_water_depth double precision,
+    deriv double precision,
+    change_pt double precision,
+    smoothed_min_water_depth double precision,
+    sensor_water_level double precision,
+    road_water_level double precision,
+    sensor_water_level_adj double precision,
+    road_water_level_adj double precision,
+    CONSTRAINT data_for_display_pkey PRIMARY KEY (place, "sensor_ID", date)
+);
+"""
+
+
+##########################
+# Synthetic observations #
+##########################
+
+def observation_dates(source, begin_date, end_date):
+    interval = OBSERVATION_INTERVAL[source]
+    latest = pd.Timestamp.now(tz = "UTC") - REPORTING_LAG
+
+    return pd.date_range(begin_date.ceil(interval), min(end_date, latest), freq = interval)
+
+
+def noaa_payload(station_id, dates):
+    pressure = synthetic_atm_pressure(station_id, dates)
+    data = [{"t": d.strftime("%Y-%m-%d %H:%M"), "v": f"{p:.1f}", "f": "0,0,0"} for d, p in zip(dates, pressure)]
+
+    return json.dumps({"metadata": {"id": str(station_id), "name": "Load test", "lat": "34.7", "lon": "-76.6"}, "data": data}).encode()
+
+
+def isu_payload(station_id, dates, columns = ISU_COLUMNS):
+    alti = synthetic_atm_pressure(station_id, dates) / 33.8639
+    preamble = "#DEBUG: Format Typ    -> comma\n#DEBUG: Time Period   -> load test\n#DEBUG: Time Zone     -> UTC\n#DEBUG: Entries Found -> -1\n"
+
+    values = {"station": str(station_id), "lon": "-76.6", "lat": "34.7"}
+    lines = [",".join(columns)]
+    for d, a in zip(dates, alti):
+        row = {**values, "valid": d.strftime("%Y-%m-%d %H:%M"), "alti": f"{a:.2f}"}
+        lines.append(",".join(row.get(col, "M") for col in columns))
+
+    return (preamble + "\n".join(lines) + "\n").encode()
+
+
+def fiman_payload(site_id, sensor_id, dates):
+    pressure = synthetic_atm_pressure(site_id, dates)
+
+    rows = "".join(f"<row><or_site_id>{site_id}</or_site_id><site_id>{site_id}</site_id><or_sensor_id>{sensor_id}</or_sensor_id>"
+                   f"<sensor_class>30</sensor_class><data_time>{d.strftime('%Y-%m-%d %H:%M:%S')}</data_time>"
+                   f"<data_value>{p:.2f}</data_value><data_quality>A</data_quality><raw_value>{p:.2f}</raw_value><units>mb</units></row>"
+                   for d, p in zip(dates, pressure))
+
+    return f'<?xml version="1.0" encoding="UTF-8"?><onerain><response><general>{rows}</general></response></onerain>'.encode()
+
+
+##########################
+# Service stand-ins      #
+##########################
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve synthetic or recorded responses in the format of each atm pressure service
+
+    Routes: /noaa (NOAA JSON), /isu (ISU comma CSV), /fiman (FIMAN onerain XML)
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        source = url.path.strip("/").upper()
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        settings = self.server.settings
+
+        with self.server.lock:
+            self.server.requests[source] += 1
+
+        time.sleep(settings["latency_ms"] / 1000)
+
+        if source not in ATM_SOURCES:
+            return self.respond(404, b"Unknown service", "text/plain")
+
+        if random.random() < settings["error_rate"]:
+            with self.server.lock:
+                self.server.errors[source] += 1
+            return self.respond(500, b"Injected error", "text/plain")
+
+        recorded = settings["recorded"].get(source)
+        if recorded is not None:
+            return self.respond(200, recorded, self.content_type(source))
+
+        return self.respond(200, self.synthetic(source, query), self.content_type(source))
+
+    def synthetic(self, source, query):
+        match source:
+            case "NOAA":
+                begin_date = pd.to_datetime(query["begin_date"], format = "%Y%m%d %H:%M", utc = True)
+                end_date = pd.to_datetime(query["end_date"], format = "%Y%m%d %H:%M", utc = True)
+                return noaa_payload(query["station"], observation_dates(source, begin_date, end_date))
+            case "ISU":
+                begin_date = pd.Timestamp(int(query["year1"]), int(query["month1"]), int(query["day1"]), tz = "UTC")
+                end_date = pd.Timestamp(int(query["year2"]), int(query["month2"]), 1, tz = "UTC") + pd.Timedelta(days = int(query["day2"]) - 1)
+                columns = ISU_COLUMNS if query.get("data", "all") == "all" else ["station", "valid", "lon", "lat"] + query["data"].split(",")
+                return isu_payload(query["station"], observation_dates(source, begin_date, end_date), columns)
+            case "FIMAN":
+                begin_date = pd.to_datetime(query["data_start"], utc = True)
+                end_date = pd.to_datetime(query["end_date"], utc = True)
+                return fiman_payload(query["site_id"], query["sensor_id"], observation_dates(source, begin_date, end_date))
+
+    @staticmethod
+    def content_type(source):
+        return {"NOAA": "application/json", "ISU": "text/plain", "FIMAN": "text/xml"}[source]
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_ins(latency_ms = 0, error_rate = 0, recorded_dir = None):
+    """Start the atm pressure service stand-ins on a free local port
+
+    Args:
+        latency_ms (float): Delay added to every response
+        error_rate (float): Fraction of requests answered with HTTP 500
+        recorded_dir (str): Optional directory with `noaa.json`, `isu.csv` and/or `fiman.xml` to replay instead of synthetic data
+
+    Returns:
+        ThreadingHTTPServer: Running server. Stop it with `shutdown()`
+    """
+    recorded = {}
+    if recorded_dir is not None:
+        for source, file_name in {"NOAA": "noaa.json", "ISU": "isu.csv", "FIMAN": "fiman.xml"}.items():
+            path = os.path.join(recorded_dir, file_name)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    recorded[source] = f.read()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.settings = {"latency_ms": latency_ms, "error_rate": error_rate, "recorded": recorded}
+    server.lock = threading.Lock()
+    server.requests = defaultdict(int)
+    server.errors = defaultdict(int)
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    return server
+
+
+##########################
+# Throwaway database     #
+##########################
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_postgres_cluster(workdir):
+    """Create and start a temporary Postgres cluster. Returns the server URL and a function that stops it"""
+    if shutil.which("initdb") is None or shutil.which("pg_ctl") is None:
+        raise RuntimeError("initdb/pg_ctl not found on the PATH. Install Postgres or pass --database-url")
+
+    data_dir = os.path.join(workdir, "pgdata")
+    port = free_port()
+
+    subprocess.run(["initdb", "-D", data_dir, "-U", "postgres", "--auth", "trust"], check = True, stdout = subprocess.DEVNULL)
+    subprocess.run(["pg_ctl", "start", "-D", data_dir, "-w", "-l", os.path.join(workdir, "postgres.log"),
+                    "-o", f"-p {port} -k {workdir} -c listen_addresses=127.0.0.1 -c fsync=off"], check = True, stdout = subprocess.DEVNULL)
+
+    def stop():
+        subprocess.run(["pg_ctl", "stop", "-D", data_dir, "-w", "-m", "fast"], stdout = subprocess.DEVNULL)
+
+    return f"postgresql://postgres@127.0.0.1:{port}/postgres", stop
+
+
+def create_test_database(server_url, database):
+    admin_engine = create_engine(server_url, isolation_level = "AUTOCOMMIT")
+    with admin_engine.connect() as conn:
+        conn.execute(text(f'CREATE DATABASE "{database}"'))
+    admin_engine.dispose()
+
+    return make_url(server_url).set(database = database)
+
+
+def drop_test_database(server_url, database):
+    admin_engine = create_engine(server_url, isolation_level = "AUTOCOMMIT")
+    with admin_engine.connect() as conn:
+        conn.execute(text(f'DROP DATABASE IF EXISTS "{database}"'))
+    admin_engine.dispose()
+
+
+def copy_frame(df, table, engine):
+    """Bulk load a DataFrame with COPY"""
+    buffer = StringIO()
+    df.to_csv(buffer, index = False, header = False)
+    buffer.seek(0)
+
+    columns = ", ".join(f'"{col}"' for col in df.columns)
+    raw_conn = engine.raw_connection()
+    try:
+        with raw_conn.cursor() as cur:
+            cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        raw_conn.commit()
+    finally:
+        raw_conn.close()
+
+
+def seed_database(engine, places, sensors_per_place, days, interval_minutes):
+    """Create the pipeline tables and fill them with synthetic sensors, surveys and raw observations
+
+    Returns:
+        pd.DataFrame: FIMAN gauge keys for the seeded FIMAN stations
+    """
+    with engine.begin() as conn:
+        conn.execute(text(BASE_SCHEMA))
+
+    end_date = pd.Timestamp.now(tz = "UTC").floor("min")
+    start_date = end_date - pd.Timedelta(days = days)
+    dates = pd.date_range(start_date, end_date, freq = f"{interval_minutes}min")
+
+    surveys = []
+    observations = []
+    gauge_keys = []
+
+    for p in range(places):
+        place = f"Load test place {p}"
+        atm_data_src = ATM_SOURCES[p % len(ATM_SOURCES)]
+        atm_station_id = f"{atm_data_src}{p:04d}"
+
+        if atm_data_src == "FIMAN":
+            gauge_keys.append({"site_id": atm_station_id, "Sensor": "Barometric Pressure", "sensor_id": f"{p}01"})
+
+        for s in range(sensors_per_place):
+            sensor_ID = f"LT_{p:04d}_{s:02d}"
+
+            surveys.append({"place": place, "sensor_ID": sensor_ID, "date_surveyed": start_date - pd.Timedelta(days = 30),
+                            "sensor_elevation": 1.5 + 0.1 * s, "road_elevation": 3.0 + 0.1 * s, "lat": 34.7, "lng": -76.6,
+                            "alert_threshold": 0.0, "atm_data_src": atm_data_src, "atm_station_id": atm_station_id, "notes": "load test"})
+
+            water_depth_m = synthetic_water_depth(sensor_ID, dates) / 3.28084
+            pressure = synthetic_atm_pressure(atm_station_id, dates) + water_depth_m * 1020 * 9.81 / 100
+
+            observations.append(pd.DataFrame({"place": place, "sensor_ID": sensor_ID, "date": dates, "pressure": pressure,
+                                              "voltage": 4.1, "notes": "load test", "processed": False}))
+
+    copy_frame(pd.DataFrame(surveys), "sensor_surveys", engine)
+    copy_frame(pd.concat(observations, ignore_index = True), "sensor_data", engine)
+
+    return pd.DataFrame(gauge_keys, columns = ["site_id", "Sensor", "sensor_id"])
+
+
+##########################
+# Stage timing           #
+##########################
+
+class StageTimer:
+    """Wrap module-level functions so every call is timed under a stage name"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.originals = []
+
+    def wrap(self, module, name, stage = None):
+        original = getattr(module, name)
+        stage = stage or f"{module.__name__}.{name}"
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+
+        setattr(module, name, timed)
+        self.originals.append((module, name, original))
+
+    def restore(self):
+        for module, name, original in reversed(self.originals):
+            setattr(module, name, original)
+        self.originals = []
+
+
+def instrument_pipeline(timer):
+    import atm_grid
+    import drift_correction
+    import process_pressure
+
+    for name in ["match_measurements_to_survey", "interpolate_atm_data_from_grid", "interpolate_atm_data", "format_interpolated_data"]:
+        timer.wrap(process_pressure, name)
+
+    timer.wrap(atm_grid, "get_atm_pressure", "atm_grid.get_atm_pressure (fetch)")
+    timer.wrap(atm_grid, "write_atm_grid")
+
+    for name in ["get_wd_w_buffer", "get_surveys", "qa_qc_flag", "calc_baseline_wl_batched", "correct_drift", "write_changed_rows"]:
+        timer.wrap(drift_correction, name)
+
+    timer.wrap(process_pressure, "main", "process_pressure.main (total)")
+    timer.wrap(drift_correction, "main", "drift_correction.main (total)")
+
+    return process_pressure, drift_correction
+
+
+def count_rows(engine, table):
+    with engine.connect() as conn:
+        return conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+
+
+def run_load_test(args):
+    workdir = tempfile.mkdtemp(prefix = "sdfp_load_test_")
+    stop_cluster = None
+    server = None
+    server_url = args.database_url
+    database = f"sdfp_load_test_{os.getpid()}"
+    original_cwd = os.getcwd()
+
+    try:
+        if server_url is None:
+            server_url, stop_cluster = start_postgres_cluster(workdir)
+
+        db_url = create_test_database(server_url, database)
+        engine = create_engine(db_url)
+
+        seed_start = time.perf_counter()
+        gauge_keys = seed_database(engine, args.places, args.sensors_per_place, args.days, args.interval_minutes)
+        seed_seconds = time.perf_counter() - seed_start
+        raw_rows = count_rows(engine, "sensor_data")
+
+        if args.partitioned:
+            for table in PARTITIONED_TABLES:
+                migrate_to_partitioned(engine, table, drop_old = True)
+
+        # get_fiman_atm reads the gauge key relative to the working directory
+        os.makedirs(os.path.join(workdir, "data"), exist_ok = True)
+        gauge_keys.to_csv(os.path.join(workdir, "data", "fiman_gauge_key.csv"), index = False)
+        os.chdir(workdir)
+
+        server = start_stand_ins(args.latency_ms, args.error_rate, args.recorded_dir)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        os.environ.update({"POSTGRESQL_USER": db_url.username, "POSTGRESQL_PASSWORD": db_url.password or "",
+                           "POSTGRESQL_HOSTNAME": f"{db_url.host}:{db_url.port or 5432}", "POSTGRESQL_DATABASE": database,
+                           "NOAA_URL": f"{base_url}/noaa", "ISU_URL": f"{base_url}/isu", "FIMAN_URL": f"{base_url}/fiman"})
+
+        timer = StageTimer()
+        process_pressure, drift_correction = instrument_pipeline(timer)
+
+        try:
+            run_start = time.perf_counter()
+            process_pressure.main()
+            drift_correction.main()
+            run_seconds = time.perf_counter() - run_start
+        finally:
+            timer.restore()
+
+        report = {"raw_rows": raw_rows,
+                  "processed_rows": count_rows(engine, "sensor_water_depth"),
+                  "display_rows": count_rows(engine, "data_for_display"),
+                  "seed_seconds": seed_seconds,
+                  "run_seconds": run_seconds,
+                  "rows_per_second": raw_rows / run_seconds if run_seconds > 0 else float("nan"),
+                  "stages": {stage: {"seconds": timer.seconds[stage], "calls": timer.calls[stage]} for stage in timer.seconds},
+                  "requests": dict(server.requests),
+                  "injected_errors": dict(server.errors)}
+
+        engine.dispose()
+
+        return report
+    finally:
+        os.chdir(original_cwd)
+        if server is not None:
+            server.shutdown()
+        if args.keep:
+            print(f"Kept database {database} on {server_url} (working directory: {workdir})")
+        else:
+            if server_url is not None:
+                try:
+                    drop_test_database(server_url, database)
+                except Exception as e:
+                    print(f"Could not drop {database}: {e}")
+            if stop_cluster is not None:
+                stop_cluster()
+            shutil.rmtree(workdir, ignore_errors = True)
+
+
+def print_report(report):
+    print("####################################")
+    print(f"- Raw rows seeded:           {report['raw_rows']} ({report['seed_seconds']:.1f} s)")
+    print(f"- Rows with water depth:     {report['processed_rows']}")
+    print(f"- Rows for display:          {report['display_rows']}")
+    print(f"- End-to-end time:           {report['run_seconds']:.2f} s")
+    print(f"- Throughput:                {report['rows_per_second']:.0f} rows/sec")
+    print("- Stage timings:")
+    for stage, t in sorted(report["stages"].items(), key = lambda s: -s[1]["seconds"]):
+        print(f"    {stage:<50} {t['seconds']:>9.2f} s  {t['calls']:>6} call(s)")
+    print(f"- Stand-in requests:         {report['requests']}")
+    print(f"- Injected errors:           {report['injected_errors']}")
+    print("####################################")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "End-to-end load test of process_pressure and drift_correction against local stand-ins")
+    parser.add_argument("--places", type = int, default = 6, help = "Number of places. Atm sources alternate NOAA, ISU, FIMAN")
+    parser.add_argument("--sensors-per-place", type = int, default = 3)
+    parser.add_argument("--days", type = float, default = 3, help = "Days of raw sensor data to seed, ending now")
+    parser.add_argument("--interval-minutes", type = int, default = 6, help = "Spacing of the raw sensor observations")
+    parser.add_argument("--latency-ms", type = float, default = 0, help = "Latency added to every stand-in response")
+    parser.add_argument("--error-rate", type = float, default = 0, help = "Fraction of stand-in requests answered with HTTP 500")
+    parser.add_argument("--recorded-dir", help = "Replay noaa.json, isu.csv and fiman.xml from this directory instead of synthetic responses")
+    parser.add_argument("--database-url", help = "Postgres server to create the throwaway database on. Default: start a temporary cluster")
+    parser.add_argument("--partitioned", action = "store_true", help = "Partition the output tables by month before running")
+    parser.add_argument("--keep", action = "store_true", help = "Keep the test database (and temporary cluster) for inspection")
+    parser.add_argument("--json", help = "Also write the report to this file")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_load_test(args)
+    print_report(report)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent = 2)
@@ -0,0 +1,203 @@
+"""Memory accounting for the pipeline stages
+
+Each stage runs inside `stage(name)`, which records its peak allocation (with tracemalloc) or peak
+resident set size (by sampling RSS in a background thread) and, when the number of rows is known,
+an estimate of bytes per row. Given a memory budget, `chunk_size(name)` turns those estimates into
+chunk sizes for the stages that really work a chunk at a time (database writes and exports), and
+`report()` lists the stages that allocate the most. Reads of whole tables into one DataFrame are
+measured but not bounded.
+
+Configured with environment variables:
+    MEMORY_TRACKING: "tracemalloc", "rss" or "off". Default: "rss" if a budget is set, else "off"
+    MEMORY_BUDGET_MB: Memory the pipeline may use. Chunk sizes are only adapted when this is set
+    MEMORY_PROFILE_PATH: JSON file to keep bytes-per-row estimates between runs
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Fraction of the free budget a single chunk may use
+CHUNK_BUDGET_FRACTION = 0.25
+
+# Smaller batches are dominated by fixed overhead and would overstate bytes per row
+MIN_ROWS_FOR_ESTIMATE = 1000
+
+
+########################
+# Utility functions    #
+########################
+
+def current_rss_bytes():
+    """Resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is the peak, not the current size, but it is the best available off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """Sample RSS in a background thread and keep the peak"""
+
+    def __init__(self, interval = 0.05):
+        self.interval = interval
+        self.peak = current_rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_bytes())
+
+
+########################
+# Memory tracker       #
+########################
+
+class MemoryTracker:
+    """Per-stage memory accounting and budget-based chunk sizing
+
+    Args:
+        mode (str): "tracemalloc", "rss" or "off"
+        budget_bytes (int): Memory the pipeline may use. None to keep default chunk sizes
+        profile_path (str): Optional JSON file with bytes-per-row estimates from earlier runs
+    """
+
+    def __init__(self, mode = "off", budget_bytes = None, profile_path = None):
+        self.mode = mode
+        self.budget_bytes = budget_bytes
+        self.profile_path = profile_path
+        self.stages = {}
+        self._stack = []
+        self.bytes_per_row = {}
+
+        if profile_path is not None and os.path.exists(profile_path):
+            with open(profile_path) as f:
+                self.bytes_per_row = json.load(f)
+
+    @classmethod
+    def from_env(cls):
+        budget_mb = os.environ.get("MEMORY_BUDGET_MB")
+        budget_bytes = int(float(budget_mb) * 1024 ** 2) if budget_mb else None
+        mode = os.environ.get("MEMORY_TRACKING", "rss" if budget_bytes is not None else "off").lower()
+
+        return cls(mode = mode, budget_bytes = budget_bytes, profile_path = os.environ.get("MEMORY_PROFILE_PATH"))
+
+    @contextmanager
+    def stage(self, name, rows = None):
+        """Account the memory used while the block runs
+
+        Yields a dict; set its "rows" entry inside the block if the row count is only known there.
+        """
+        info = {"rows": rows}
+
+        if self.mode == "off":
+            yield info
+            return
+
+        start = time.perf_counter()
+
+        if self.mode == "tracemalloc":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+            frame = {"before": tracemalloc.get_traced_memory()[0], "peak": 0}
+            self._stack.append(frame)
+            try:
+                yield info
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                frame["peak"] = max(frame["peak"], peak)
+                self._stack.pop()
+                if self._stack:
+                    self._stack[-1]["peak"] = max(self._stack[-1]["peak"], frame["peak"])
+                tracemalloc.reset_peak()
+
+                self._record(name, frame["peak"] - frame["before"], current - frame["before"], info["rows"], time.perf_counter() - start)
+        else:
+            before = current_rss_bytes()
+            with RssSampler() as sampler:
+                yield info
+            self._record(name, sampler.peak - before, current_rss_bytes() - before, info["rows"], time.perf_counter() - start)
+
+    def _record(self, name, peak_bytes, retained_bytes, rows, seconds):
+        record = self.stages.setdefault(name, {"calls": 0, "peak_bytes": 0, "retained_bytes": 0, "rows": 0, "seconds": 0.0})
+        record["calls"] += 1
+        record["peak_bytes"] = max(record["peak_bytes"], peak_bytes)
+        record["retained_bytes"] += retained_bytes
+        record["seconds"] += seconds
+
+        if rows:
+            record["rows"] += rows
+
+        if rows and rows >= MIN_ROWS_FOR_ESTIMATE:
+            estimate = max(peak_bytes, 0) / rows
+            if estimate > 0:
+                # Keep the worst case seen, so chunk sizes stay on the safe side
+                self.bytes_per_row[name] = max(self.bytes_per_row.get(name, 0), estimate)
+
+    def chunk_size(self, name, default = 3000, minimum = 100, maximum = 100000):
+        """Rows per chunk for a stage, so one chunk fits in a share of the free memory budget
+
+        Falls back to `default` without a budget or before the stage has a bytes-per-row estimate.
+        """
+        bytes_per_row = self.bytes_per_row.get(name)
+
+        if self.budget_bytes is None or not bytes_per_row:
+            return default
+
+        free_bytes = max(self.budget_bytes - current_rss_bytes(), 0)
+
+        return int(min(max(free_bytes * CHUNK_BUDGET_FRACTION / bytes_per_row, minimum), maximum))
+
+    def report(self):
+        """Print the stages by peak allocation and save bytes-per-row estimates"""
+        if self.mode == "off":
+            return
+
+        print("####################################")
+        print(f"- Memory by stage ({self.mode}), largest peak first")
+        for name, record in sorted(self.stages.items(), key = lambda s: -s[1]["peak_bytes"]):
+            per_row = f"{self.bytes_per_row[name]:.0f} B/row" if name in self.bytes_per_row else ""
+            print(f"    {name:<40} peak {record['peak_bytes'] / 1024 ** 2:>9.1f} MB  retained {record['retained_bytes'] / 1024 ** 2:>9.1f} MB  "
+                  f"{record['rows']:>9} rows  {record['seconds']:>7.1f} s  {per_row}")
+        if self.budget_bytes is not None:
+            print(f"- Budget: {self.budget_bytes / 1024 ** 2:.0f} MB, current RSS: {current_rss_bytes() / 1024 ** 2:.0f} MB")
+        print("####################################")
+
+        if self.profile_path is not None:
+            with open(self.profile_path, "w") as f:
+                json.dump(self.bytes_per_row, f, indent = 2)
+
+
+TRACKER = MemoryTracker.from_env()
+
+
+def stage(name, rows = None):
+    return TRACKER.stage(name, rows = rows)
+
+
+def chunk_size(name, default = 3000, minimum = 100, maximum = 100000):
+    return TRACKER.chunk_size(name, default = default, minimum = minimum, maximum = maximum)
+
+
+def report():
+    TRACKER.report()
@@ -0,0 +1,310 @@
+"""Monthly time partitioning of the pipeline output tables
+
+`sensor_water_depth` and `data_for_display` can be converted to tables partitioned by month on
+`date`. Writers route each batch to the partition of its month, readers filter on the bare `date`
+column so Postgres can prune partitions, and retention drops whole partitions.
+
+Every write also stamps the (place, sensor_ID, month)s it touched in `output_change_marks`, so
+consumers such as the exporter can tell which months changed without scanning them.
+
+Usage:
+    python partitions.py migrate [--drop-old]
+    python partitions.py ensure --months-ahead 3
+    python partitions.py retention --keep-months 36
+"""
+
+import argparse
+import os
+import re
+import warnings
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+PARTITIONED_TABLES = ["sensor_water_depth", "data_for_display"]
+PRIMARY_KEY = 'place, "sensor_ID", date'
+
+# Rows fetched per round trip by `read_sql_streamed`
+STREAM_CHUNK_ROWS = 50000
+
+CHANGE_MARKS_TABLE = "output_change_marks"
+
+CREATE_CHANGE_MARKS_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {CHANGE_MARKS_TABLE} (
+    table_name text NOT NULL,
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    month date NOT NULL,
+    changed_at timestamptz NOT NULL,
+    CONSTRAINT {CHANGE_MARKS_TABLE}_pkey PRIMARY KEY (table_name, place, "sensor_ID", month)
+)
+"""
+
+_partitioned_cache = {}
+_change_marks_created = set()
+
+
+########################
+# Utility functions    #
+########################
+
+def month_starts(dates):
+    """Sorted first-of-month timestamps (UTC) for every month that `dates` falls in"""
+    utc_dates = pd.DatetimeIndex(pd.to_datetime(dates, utc = True)).dropna()
+    months = sorted(set(zip(utc_dates.year, utc_dates.month)))
+
+    return [pd.Timestamp(year, month, 1, tz = "UTC") for year, month in months]
+
+
+def partition_name(table, month_start):
+    return f"{table}_y{month_start.year:04d}m{month_start.month:02d}"
+
+
+def is_partitioned(engine, table):
+    """True if `table` is a partitioned table. Cached per engine and table"""
+    key = (str(engine.url), table)
+
+    if key not in _partitioned_cache:
+        with engine.connect() as conn:
+            relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}).scalar()
+        _partitioned_cache[key] = relkind == "p"
+
+    return _partitioned_cache[key]
+
+
+def create_partitions(conn, table, dates):
+    for month_start in month_starts(dates):
+        month_end = month_start + pd.offsets.MonthBegin(1)
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {partition_name(table, month_start)} PARTITION OF {table} "
+                          f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{month_end.isoformat()}')"))
+
+
+def ensure_partitions(engine, table, dates):
+    """Create the monthly partitions of `table` needed to hold `dates`"""
+    with engine.begin() as conn:
+        create_partitions(conn, table, dates)
+
+
+def list_partitions(engine, table):
+    """Names and month starts of the monthly partitions of `table`"""
+    query = text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table)")
+
+    with engine.connect() as conn:
+        names = [row.relname for row in conn.execute(query, {"table": table})]
+
+    partitions = []
+    for name in names:
+        match = re.fullmatch(rf"{re.escape(table)}_y(\d{{4}})m(\d{{2}})", name)
+        if match is not None:
+            partitions.append((name, pd.Timestamp(int(match.group(1)), int(match.group(2)), 1, tz = "UTC")))
+
+    return sorted(partitions, key = lambda p: p[1])
+
+
+########################
+# Reading and writing  #
+########################
+
+def mark_changed_months(x, table, engine):
+    """Stamp every (place, sensor_ID, month) of the rows in `x` as changed now
+
+    The marks table is created the first time a process writes to it.
+    """
+    key = str(engine.url)
+
+    if key not in _change_marks_created:
+        with engine.begin() as conn:
+            conn.execute(text(CREATE_CHANGE_MARKS_TABLE))
+        _change_marks_created.add(key)
+
+    dates = pd.DatetimeIndex(pd.to_datetime(x.index.get_level_values("date"), utc = True))
+    months = pd.DataFrame({"place": x.index.get_level_values("place"),
+                           "sensor_ID": x.index.get_level_values("sensor_ID"),
+                           "month": dates.tz_localize(None).to_period("M").to_timestamp()}).drop_duplicates()
+
+    query = text(f"""
+        INSERT INTO {CHANGE_MARKS_TABLE} (table_name, place, "sensor_ID", month, changed_at)
+        SELECT :table, t.place, t.sensor, t.month, now()
+        FROM unnest(CAST(:places AS text[]), CAST(:sensors AS text[]), CAST(:months AS date[])) AS t(place, sensor, month)
+        ON CONFLICT ON CONSTRAINT {CHANGE_MARKS_TABLE}_pkey DO UPDATE SET changed_at = excluded.changed_at
+    """)
+
+    with engine.begin() as conn:
+        conn.execute(query, {"table": table, "places": list(months["place"].astype(str)), "sensors": list(months["sensor_ID"].astype(str)),
+                             "months": [m.date() for m in months["month"]]})
+
+
+def write_partitioned(x, table, engine, method, chunksize = 3000):
+    """Write `x` with `to_sql`, routing rows straight to the monthly partitions when `table` is partitioned
+
+    The months written are stamped with `mark_changed_months` afterwards. A failed stamp is only
+    warned about, since the rows themselves are written.
+
+    Args:
+        x (pd.DataFrame): Rows indexed by the primary key of `table`, including `date`
+        table (str): Name of the (possibly partitioned) table
+        engine (sqlalchemy.engine.Engine): Database engine
+        method (callable): `to_sql` insert method, e.g. `postgres_upsert`
+        chunksize (int): Number of rows per statement
+    """
+    if not is_partitioned(engine, table):
+        x.to_sql(table, engine, if_exists = "append", method = method, chunksize = chunksize)
+    else:
+        dates = pd.DatetimeIndex(pd.to_datetime(x.index.get_level_values("date"), utc = True))
+        ensure_partitions(engine, table, dates)
+
+        month_key = dates.year * 12 + dates.month - 1
+
+        for key, batch in x.groupby(month_key.to_numpy()):
+            month_start = pd.Timestamp(int(key) // 12, int(key) % 12 + 1, 1, tz = "UTC")
+            batch.to_sql(partition_name(table, month_start), engine, if_exists = "append", method = method, chunksize = chunksize)
+
+    try:
+        mark_changed_months(x, table, engine)
+    except Exception as e:
+        warnings.warn(f"Error marking changed months of {table}: {e}")
+
+
+def iter_sql_chunks(query, engine, params = None, chunksize = 3000):
+    """Yield the result of a query in DataFrames of `chunksize` rows, read through a server-side cursor"""
+    with engine.connect().execution_options(stream_results = True) as conn:
+        yield from pd.read_sql_query(query, conn, params = params, chunksize = chunksize)
+
+
+def read_sql_streamed(query, engine, params = None, chunksize = None):
+    """Run a query through a server-side cursor, fetching `chunksize` rows at a time
+
+    The chunks are concatenated, so the result is still held in memory in full (briefly twice,
+    during the concat). Streaming only avoids the driver buffering every raw row on top of that.
+    Use `iter_sql_chunks` to process a result chunk by chunk. Without `chunksize` the whole
+    result is fetched at once, like `pd.read_sql_query`.
+    """
+    if chunksize is None:
+        return pd.read_sql_query(query, engine, params = params)
+
+    chunks = list(iter_sql_chunks(query, engine, params = params, chunksize = chunksize))
+
+    return pd.concat(chunks, ignore_index = True) if len(chunks) > 0 else pd.DataFrame()
+
+
+def read_date_range(table, engine, start_date, end_date, columns = None, sensors = None, chunksize = None):
+    """Read rows of `table` between two dates (inclusive)
+
+    The date bounds are bound parameters compared against the bare `date` column so that only the
+    partitions overlapping the range are scanned.
+
+    Args:
+        table (str): Table to read
+        engine (sqlalchemy.engine.Engine): Database engine
+        start_date (pd.Timestamp): Beginning of the range
+        end_date (pd.Timestamp): End of the range
+        columns (list): Columns to return. Default: all
+        sensors (list): Only return these sensors. Default: all
+        chunksize (int): Stream the result in chunks of this many rows. Default: fetch all at once
+
+    Returns:
+        pd.DataFrame: Matching rows
+    """
+    column_list = "*" if columns is None else ", ".join(f'"{col}"' for col in columns)
+    query = f"SELECT {column_list} FROM {table} WHERE date >= :start_date AND date <= :end_date"
+    params = {"start_date": pd.Timestamp(start_date), "end_date": pd.Timestamp(end_date)}
+
+    if sensors is not None:
+        query += ' AND "sensor_ID" = ANY(:sensors)'
+        params["sensors"] = list(sensors)
+
+    return read_sql_streamed(text(query), engine, params = params, chunksize = chunksize)
+
+
+########################
+# Migrations           #
+########################
+
+def migrate_to_partitioned(engine, table, months_ahead = 3, drop_old = False):
+    """Convert `table` into a table partitioned by month on `date`
+
+    The existing table is renamed to `<table>_unpartitioned`, a partitioned table with the same
+    columns and primary key takes its name, and all rows are copied over. The old table is kept
+    unless `drop_old` is set.
+    """
+    if is_partitioned(engine, table):
+        print(f"- {table} is already partitioned")
+        return
+
+    old_table = f"{table}_unpartitioned"
+    now = pd.Timestamp.now(tz = "UTC")
+
+    with engine.begin() as conn:
+        date_range = conn.execute(text(f"SELECT min(date), max(date) FROM {table}")).one()
+        first_date = now if date_range[0] is None else min(pd.Timestamp(date_range[0]), now)
+        last_date = now if date_range[1] is None else max(pd.Timestamp(date_range[1]), now)
+
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {old_table}"))
+        conn.execute(text(f"ALTER TABLE {old_table} RENAME CONSTRAINT {table}_pkey TO {old_table}_pkey"))
+        conn.execute(text(f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS) PARTITION BY RANGE (date)"))
+        conn.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({PRIMARY_KEY})"))
+
+        create_partitions(conn, table, pd.date_range(month_starts([first_date])[0], last_date + pd.offsets.MonthBegin(months_ahead), freq = "MS"))
+
+        rows = conn.execute(text(f"INSERT INTO {table} SELECT * FROM {old_table}")).rowcount
+
+        if drop_old:
+            conn.execute(text(f"DROP TABLE {old_table}"))
+
+    _partitioned_cache.pop((str(engine.url), table), None)
+
+    print(f"- Partitioned {table} by month, {rows} rows copied")
+
+
+def drop_partitions_before(engine, table, cutoff):
+    """Drop the monthly partitions of `table` that end on or before `cutoff`
+
+    Returns:
+        list: Names of the dropped partitions
+    """
+    expired = [name for name, month_start in list_partitions(engine, table) if month_start + pd.offsets.MonthBegin(1) <= cutoff]
+    dropped = []
+
+    with engine.begin() as conn:
+        for name in expired:
+            conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+
+    return dropped
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Manage monthly partitions of the pipeline output tables")
+    parser.add_argument("command", choices = ["migrate", "ensure", "retention"])
+    parser.add_argument("--tables", nargs = "+", default = PARTITIONED_TABLES)
+    parser.add_argument("--months-ahead", type = int, default = 3, help = "Create partitions this many months past the current one")
+    parser.add_argument("--keep-months", type = int, default = 36, help = "Retention: keep partitions for this many months before the current one")
+    parser.add_argument("--drop-old", action = "store_true", help = "Migrate: drop the original table after copying its rows")
+    args = parser.parse_args()
+
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+    now = pd.Timestamp.now(tz = "UTC")
+
+    for table in args.tables:
+        match args.command:
+            case "migrate":
+                migrate_to_partitioned(engine, table, months_ahead = args.months_ahead, drop_old = args.drop_old)
+            case "ensure":
+                if not is_partitioned(engine, table):
+                    warnings.warn(f"{table} is not partitioned. Run `python partitions.py migrate` first")
+                    continue
+                ensure_partitions(engine, table, pd.date_range(month_starts([now])[0], now + pd.offsets.MonthBegin(args.months_ahead), freq = "MS"))
+                print(f"- Partitions of {table} exist through {args.months_ahead} month(s) ahead")
+            case "retention":
+                cutoff = month_starts([now])[0] - pd.DateOffset(months = args.keep_months)
+                dropped = drop_partitions_before(engine, table, cutoff)
+                print(f"- Dropped {len(dropped)} partition(s) of {table} before {cutoff.date()}")
+
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Queue of raw observations deferred because atm pressure does not cover them yet
+
+When sensor rows are newer than the latest available atm observation they cannot be converted to
+water depth and stay unprocessed. Instead of refetching atm data for those sensors on every run,
+each (place, sensor_ID)'s deferred rows are recorded here together with the atm coverage they need,
+and the sensor is only retried after an exponential backoff. Retries go through the atm pressure
+grid, so only the missing tail of the atm record is fetched.
+
+Rows within the normal reporting lag of their atm source are not deferred: the newest readings are
+always a few minutes ahead of the latest atm observation. The backoff starts over whenever a run
+makes progress, so it only grows while a source is really stalled.
+"""
+
+import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from atm_grid import get_atm_grid_extent
+from atm_pressure import postgres_upsert
+
+PENDING_TABLE = "atm_pending_observations"
+
+CREATE_PENDING_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {PENDING_TABLE} (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    atm_data_src text,
+    atm_station_id text,
+    deferred_rows integer NOT NULL,
+    first_deferred_date timestamptz,
+    last_deferred_date timestamptz,
+    atm_covered_until timestamptz,
+    attempts integer NOT NULL DEFAULT 0,
+    next_attempt_at timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT {PENDING_TABLE}_pkey PRIMARY KEY (place, "sensor_ID")
+)
+"""
+
+KEY_COLS = ["place", "sensor_ID"]
+
+BACKOFF_BASE = datetime.timedelta(minutes = 5)
+BACKOFF_MAX = datetime.timedelta(hours = 6)
+
+# How far the latest atm observation normally trails real time, per source
+REPORTING_LAG = {"NOAA": datetime.timedelta(minutes = 30),
+                 "ISU": datetime.timedelta(minutes = 90),
+                 "FIMAN": datetime.timedelta(minutes = 45)}
+DEFAULT_REPORTING_LAG = datetime.timedelta(hours = 1)
+
+
+def create_pending_table(engine):
+    with engine.begin() as conn:
+        # The first version of the table was keyed by place only. It only schedules retries, so it is rebuilt
+        old_layout = conn.execute(text(f"""
+            SELECT 1 FROM information_schema.tables t
+            WHERE t.table_name = '{PENDING_TABLE}'
+              AND NOT EXISTS (SELECT 1 FROM information_schema.columns c WHERE c.table_name = t.table_name AND c.column_name = 'sensor_ID')
+        """)).first()
+        if old_layout is not None:
+            conn.execute(text(f"DROP TABLE {PENDING_TABLE}"))
+
+        conn.execute(text(CREATE_PENDING_TABLE))
+
+
+def get_pending(engine):
+    pending = pd.read_sql_query(text(f"SELECT * FROM {PENDING_TABLE}"), engine)
+    pending["next_attempt_at"] = pd.to_datetime(pending["next_attempt_at"], utc = True)
+    pending["atm_covered_until"] = pd.to_datetime(pending["atm_covered_until"], utc = True)
+    pending["first_deferred_date"] = pd.to_datetime(pending["first_deferred_date"], utc = True)
+
+    return pending
+
+
+def backoff(attempts):
+    """Delay before the next attempt: 5 minutes, doubling with every attempt, at most 6 hours"""
+    return min(BACKOFF_BASE * 2 ** max(attempts - 1, 0), BACKOFF_MAX)
+
+
+def reporting_lag(atm_data_src):
+    return REPORTING_LAG.get(str(atm_data_src).upper(), DEFAULT_REPORTING_LAG)
+
+
+def hold_back_pending(x, pending, debug = True):
+    """Drop the rows of sensors whose next retry is not due yet
+
+    Only rows past the atm coverage recorded for the sensor are held back. Rows the stored atm
+    pressure grid already covers are processed without fetching anything.
+
+    Args:
+        x (pd.DataFrame): Sensor observations matched to surveys
+        pending (pd.DataFrame): Rows from the pending table
+
+    Returns:
+        pd.DataFrame: Rows of `x` that should be processed now
+    """
+    now = pd.Timestamp.now(tz = "UTC")
+    not_due = pending.loc[pending["next_attempt_at"] > now, KEY_COLS + ["atm_covered_until"]]
+
+    if not_due.shape[0] == 0 or x.shape[0] == 0:
+        return x
+
+    covered_until = x.loc[:, KEY_COLS].merge(not_due, on = KEY_COLS, how = "left", indicator = True)
+    is_pending = (covered_until["_merge"] == "both").to_numpy()
+    is_covered = (pd.to_datetime(x["date"], utc = True).reset_index(drop = True) <= pd.to_datetime(covered_until["atm_covered_until"], utc = True)).to_numpy()
+    held_back = is_pending & ~is_covered
+
+    if debug == True and held_back.any():
+        print("####################################")
+        print(f"- {held_back.sum()} row(s) for {x.loc[held_back, KEY_COLS].drop_duplicates().shape[0]} sensor(s) held back until atm pressure catches up")
+        print("####################################")
+
+    return x[~held_back]
+
+
+def update_pending(engine, x, interpolated_data, pending):
+    """Record the rows that could not be matched to atm pressure and clear sensors that caught up
+
+    Unmatched rows still within the reporting lag of their atm source are not counted as deferred.
+    A sensor's backoff starts over when the run made progress: its atm coverage moved past the
+    recorded `atm_covered_until`, or rows newer than its first deferred row were processed.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        x (pd.DataFrame): Rows that were sent to atm interpolation
+        interpolated_data (pd.DataFrame): Rows that received atm pressure
+        pending (pd.DataFrame): Rows from the pending table before this run
+    """
+    keys = ["place", "sensor_ID", "date"]
+
+    if interpolated_data.shape[0] > 0:
+        matched = x.loc[:, keys].merge(interpolated_data.loc[:, keys].drop_duplicates(), on = keys, how = "left", indicator = True)["_merge"].to_numpy() == "both"
+    else:
+        matched = np.zeros(x.shape[0], dtype = bool)
+
+    now = pd.Timestamp.now(tz = "UTC")
+    dates = pd.to_datetime(x["date"], utc = True)
+    lag = pd.to_timedelta(x["atm_data_src"].map(reporting_lag))
+    past_lag = (dates < now - lag).to_numpy()
+
+    # Sensors that were not due had their newest rows held back, so this run says nothing about them
+    not_due = set(pending.loc[pending["next_attempt_at"] > now, KEY_COLS].itertuples(index = False, name = None))
+    retried = ~x.loc[:, KEY_COLS].apply(tuple, axis = 1).isin(not_due).to_numpy() if x.shape[0] > 0 else np.zeros(0, dtype = bool)
+
+    x = x[retried]; matched = matched[retried]; past_lag = past_lag[retried]
+    deferred = x[~matched & past_lag]
+
+    seen = set(x.loc[:, KEY_COLS].itertuples(index = False, name = None))
+    still_deferred = set(deferred.loc[:, KEY_COLS].itertuples(index = False, name = None))
+    caught_up = sorted(seen - still_deferred)
+
+    if len(caught_up) > 0:
+        with engine.begin() as conn:
+            conn.execute(text(f'DELETE FROM {PENDING_TABLE} WHERE (place, "sensor_ID") IN (SELECT * FROM unnest(:places, :sensors))'),
+                         {"places": [k[0] for k in caught_up], "sensors": [k[1] for k in caught_up]})
+
+    if deferred.shape[0] == 0:
+        return
+
+    previous = pending.set_index(KEY_COLS)
+    processed = x[matched]
+
+    records = []
+    for (place, sensor_ID), rows in deferred.groupby(KEY_COLS):
+        atm_data_src = rows["atm_data_src"].iloc[0]
+        atm_station_id = rows["atm_station_id"].iloc[0]
+        extent = get_atm_grid_extent(engine, atm_data_src, atm_station_id)
+        covered_until = None if extent is None else pd.Timestamp(extent[1])
+
+        attempts = 0
+        if (place, sensor_ID) in previous.index:
+            before = previous.loc[(place, sensor_ID)]
+            grid_moved = covered_until is not None and (pd.isna(before["atm_covered_until"]) or covered_until > before["atm_covered_until"])
+            sensor_processed = processed[(processed["place"] == place) & (processed["sensor_ID"] == sensor_ID)]
+            rows_processed = sensor_processed.shape[0] > 0 and pd.to_datetime(sensor_processed["date"], utc = True).max() >= before["first_deferred_date"]
+
+            attempts = 0 if grid_moved or rows_processed else before["attempts"] + 1
+
+        records.append({"place": place,
+                        "sensor_ID": sensor_ID,
+                        "atm_data_src": atm_data_src,
+                        "atm_station_id": atm_station_id,
+                        "deferred_rows": rows.shape[0],
+                        "first_deferred_date": rows["date"].min(),
+                        "last_deferred_date": rows["date"].max(),
+                        "atm_covered_until": covered_until,
+                        "attempts": int(attempts),
+                        "next_attempt_at": now + backoff(attempts),
+                        "updated_at": now})
+
+    pd.DataFrame(records).set_index(KEY_COLS).to_sql(PENDING_TABLE, engine, if_exists = "append", method = postgres_upsert)
+
+    for record in records:
+        print(f"- {record['deferred_rows']} row(s) deferred for {record['place']} / {record['sensor_ID']}, retry {record['attempts']} at {record['next_attempt_at']:%Y-%m-%d %H:%M} UTC")
@@ -0,0 +1,324 @@
+"""Multi-worker mode for process_pressure
+
+Unprocessed raw data is split into (place, sensor_ID) partitions on a work-queue table. Each worker
+claims one partition at a time with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of workers in
+any number of containers can drain the backlog without processing the same partition twice. A claim
+is a lease that the worker renews while it processes the partition: if a worker crashes, its
+partition becomes claimable again once the lease expires. A worker that loses its lease stops before
+its next write and leaves the partition to the new owner.
+
+Sensors sharing an atm station are claimed separately. The station's atm grid is refreshed by the
+first of their workers under a per-station lock, and the others reuse it (see `atm_grid.update_atm_grid`).
+
+A partition that fails is given back to the queue and retried after `RETRY_DELAY` seconds. After
+`MAX_ATTEMPTS` claims it is dead-lettered: it stays in the queue with `dead_lettered_at` and its last
+error set, is no longer claimed, and is not queued again until `--requeue-failed` resets it.
+
+Usage:
+    python pressure_workers.py --workers 4 --lease-seconds 900
+    python pressure_workers.py --requeue-failed
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import warnings
+from sqlalchemy import create_engine, text
+
+from process_pressure import get_new_data, get_surveys, process_new_data
+
+QUEUE_TABLE = "process_pressure_queue"
+
+CREATE_QUEUE_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {QUEUE_TABLE} (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    enqueued_at timestamptz NOT NULL DEFAULT now(),
+    leased_by text,
+    lease_expires timestamptz,
+    attempts integer NOT NULL DEFAULT 0,
+    last_error text,
+    dead_lettered_at timestamptz,
+    CONSTRAINT {QUEUE_TABLE}_pkey PRIMARY KEY (place, "sensor_ID")
+);
+
+ALTER TABLE {QUEUE_TABLE} ADD COLUMN IF NOT EXISTS last_error text;
+ALTER TABLE {QUEUE_TABLE} ADD COLUMN IF NOT EXISTS dead_lettered_at timestamptz;
+"""
+
+# Seconds before a failed partition may be claimed again
+RETRY_DELAY = 300
+
+# Claims of a partition before it is dead-lettered
+MAX_ATTEMPTS = 5
+
+
+class LeaseLost(Exception):
+    """The lease on a partition passed to another worker"""
+
+
+########################
+# Queue functions      #
+########################
+
+def create_queue_table(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_QUEUE_TABLE)
+
+
+def enqueue_unprocessed(engine):
+    """Add every (place, sensor_ID) with unprocessed raw data to the queue
+
+    Returns:
+        int: Number of partitions added
+    """
+    query = text(f"""
+        INSERT INTO {QUEUE_TABLE} (place, "sensor_ID")
+        SELECT DISTINCT place, "sensor_ID" FROM sensor_data WHERE processed = 'FALSE' AND pressure > 800
+        ON CONFLICT DO NOTHING
+    """)
+
+    with engine.begin() as conn:
+        return conn.execute(query).rowcount
+
+
+def claim_partition(engine, worker_id, lease_seconds, max_attempts = MAX_ATTEMPTS):
+    """Lease the oldest unleased (or expired) partition
+
+    Partitions whose lease expired after `max_attempts` claims (their worker kept crashing) are
+    dead-lettered first.
+
+    Returns:
+        tuple: (place, sensor_ID) of the claimed partition, or None if the queue is drained
+    """
+    dead_letter_expired = text(f"""
+        UPDATE {QUEUE_TABLE} SET dead_lettered_at = now(), leased_by = NULL, last_error = coalesce(last_error, 'lease expired')
+        WHERE dead_lettered_at IS NULL AND attempts >= :max_attempts AND lease_expires < now()
+    """)
+
+    query = text(f"""
+        WITH next_partition AS (
+            SELECT place, "sensor_ID" FROM {QUEUE_TABLE}
+            WHERE dead_lettered_at IS NULL AND (lease_expires IS NULL OR lease_expires < now())
+            ORDER BY enqueued_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE {QUEUE_TABLE} q
+        SET leased_by = :worker_id, lease_expires = now() + make_interval(secs => :lease_seconds), attempts = q.attempts + 1
+        FROM next_partition
+        WHERE q.place = next_partition.place AND q."sensor_ID" = next_partition."sensor_ID"
+        RETURNING q.place, q."sensor_ID"
+    """)
+
+    with engine.begin() as conn:
+        conn.execute(dead_letter_expired, {"max_attempts": max_attempts})
+        row = conn.execute(query, {"worker_id": worker_id, "lease_seconds": lease_seconds}).first()
+
+    return None if row is None else (row[0], row[1])
+
+
+def complete_partition(engine, worker_id, partition):
+    """Remove a processed partition from the queue, unless its lease has passed to another worker"""
+    query = text(f'DELETE FROM {QUEUE_TABLE} WHERE place = :place AND "sensor_ID" = :sensor_ID AND leased_by = :worker_id')
+
+    with engine.begin() as conn:
+        conn.execute(query, {"place": partition[0], "sensor_ID": partition[1], "worker_id": worker_id})
+
+
+def release_partition(engine, worker_id, partition, error, delay_seconds = RETRY_DELAY, max_attempts = MAX_ATTEMPTS):
+    """Give a failed partition back to the queue after `delay_seconds`, or dead-letter it after `max_attempts` claims
+
+    Returns:
+        bool: True if the partition was dead-lettered
+    """
+    query = text(f"""
+        UPDATE {QUEUE_TABLE}
+        SET leased_by = NULL, lease_expires = now() + make_interval(secs => :delay_seconds), last_error = :error,
+            dead_lettered_at = CASE WHEN attempts >= :max_attempts THEN now() END
+        WHERE place = :place AND "sensor_ID" = :sensor_ID AND leased_by = :worker_id
+        RETURNING dead_lettered_at IS NOT NULL
+    """)
+
+    with engine.begin() as conn:
+        row = conn.execute(query, {"place": partition[0], "sensor_ID": partition[1], "worker_id": worker_id, "error": str(error),
+                                   "delay_seconds": delay_seconds, "max_attempts": max_attempts}).first()
+
+    return row is not None and row[0]
+
+
+def requeue_dead_letters(engine):
+    """Make every dead-lettered partition claimable again with a fresh attempt count
+
+    Returns:
+        int: Number of partitions requeued
+    """
+    query = text(f"""
+        UPDATE {QUEUE_TABLE} SET dead_lettered_at = NULL, attempts = 0, lease_expires = NULL, leased_by = NULL
+        WHERE dead_lettered_at IS NOT NULL
+    """)
+
+    with engine.begin() as conn:
+        return conn.execute(query).rowcount
+
+
+def renew_lease(engine, worker_id, partition, lease_seconds):
+    """Extend the lease on a partition
+
+    Returns:
+        bool: False if the lease has passed to another worker
+    """
+    query = text(f"""
+        UPDATE {QUEUE_TABLE} SET lease_expires = now() + make_interval(secs => :lease_seconds)
+        WHERE place = :place AND "sensor_ID" = :sensor_ID AND leased_by = :worker_id
+    """)
+
+    with engine.begin() as conn:
+        return conn.execute(query, {"place": partition[0], "sensor_ID": partition[1], "worker_id": worker_id, "lease_seconds": lease_seconds}).rowcount > 0
+
+
+class LeaseHeartbeat:
+    """Renew the lease on a partition from a background thread while it is being processed
+
+    The lease is renewed every third of `lease_seconds`, so it only expires if the worker stops.
+    Call `check` before every write: it renews the lease right away and raises `LeaseLost` if it
+    has passed to another worker.
+    """
+
+    def __init__(self, engine, worker_id, partition, lease_seconds):
+        self.engine = engine
+        self.worker_id = worker_id
+        self.partition = partition
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if not renew_lease(self.engine, self.worker_id, self.partition, self.lease_seconds):
+                    self.lost = True
+                    warnings.warn(f"{self.worker_id} lost the lease on {self.partition[0]} / {self.partition[1]}")
+                    return
+            except Exception as e:
+                warnings.warn(f"{self.worker_id} failed to renew the lease on {self.partition[0]} / {self.partition[1]}: {e}")
+
+    def check(self):
+        if not self.lost and not renew_lease(self.engine, self.worker_id, self.partition, self.lease_seconds):
+            self.lost = True
+
+        if self.lost:
+            raise LeaseLost(f"{self.worker_id} lost the lease on {self.partition[0]} / {self.partition[1]}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+########################
+# Workers              #
+########################
+
+def run_worker(engine, worker_id, lease_seconds = 900, max_partitions = None):
+    """Claim and process partitions until the queue is drained
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        worker_id (str): Unique name of this worker
+        lease_seconds (int): How long a claim is held before other workers may take it over
+        max_partitions (int): Stop after this many partitions. Default: no limit
+
+    Returns:
+        int: Number of partitions processed
+    """
+    surveys = get_surveys(engine)
+
+    if surveys.shape[0] == 0:
+        warnings.warn("- No survey data!")
+        return 0
+
+    processed = 0
+
+    while max_partitions is None or processed < max_partitions:
+        partition = claim_partition(engine, worker_id, lease_seconds)
+
+        if partition is None:
+            break
+
+        print(f"- {worker_id} claimed {partition[0]} / {partition[1]}")
+
+        try:
+            with LeaseHeartbeat(engine, worker_id, partition, lease_seconds) as heartbeat:
+                new_data = get_new_data(engine, partitions = [partition], raise_errors = True)
+
+                if new_data.shape[0] > 0:
+                    process_new_data(new_data, surveys, engine, raise_errors = True, before_write = heartbeat.check)
+
+                heartbeat.check()
+                complete_partition(engine, worker_id, partition)
+        except LeaseLost as e:
+            warnings.warn(f"{e}, leaving it to its new owner")
+        except Exception as e:
+            warnings.warn(f"{worker_id} failed to process {partition[0]} / {partition[1]}: {e}")
+            if release_partition(engine, worker_id, partition, e):
+                warnings.warn(f"{partition[0]} / {partition[1]} failed {MAX_ATTEMPTS} times and was dead-lettered")
+
+        processed += 1
+
+    return processed
+
+
+def worker_main(worker_index, lease_seconds):
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{worker_index}"
+    processed = run_worker(engine, worker_id, lease_seconds = lease_seconds)
+
+    print(f"- {worker_id} processed {processed} partition(s)")
+
+    engine.dispose()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Process raw sensor data with several workers sharing a work queue")
+    parser.add_argument("--workers", type = int, default = 1, help = "Worker processes to start in this container")
+    parser.add_argument("--lease-seconds", type = int, default = 900, help = "Lease length of a claimed (place, sensor_ID) partition")
+    parser.add_argument("--requeue-failed", action = "store_true", help = "Make dead-lettered partitions claimable again before starting")
+    args = parser.parse_args()
+
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+    create_queue_table(engine)
+    if args.requeue_failed:
+        print(f"- {requeue_dead_letters(engine)} dead-lettered partition(s) requeued")
+    print(f"- {enqueue_unprocessed(engine)} new partition(s) queued")
+
+    engine.dispose()
+
+    if args.workers == 1:
+        worker_main(0, args.lease_seconds)
+        return
+
+    workers = [multiprocessing.Process(target = worker_main, args = (i, args.lease_seconds)) for i in range(args.workers)]
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,16 @@ from pytz import timezone
 import requests
 import datetime
 import pandas as pd
-from io import StringIO
 from urllib.request import urlopen
-import xmltodict
 import numpy as np
 import warnings
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+
+from atm_grid import create_atm_grid_table, interpolate_atm_data_from_grid
+from atm_parsers import fiman_gauge_key, parse_fiman, parse_isu, parse_noaa
+from pending_observations import create_pending_table, get_pending, hold_back_pending, update_pending
+from memory_budget import chunk_size, report, stage
+from partitions import STREAM_CHUNK_ROWS, read_sql_streamed, write_partitioned
 
 ########################
 # Utility functions    #
@@ -73,17 +77,10 @@ def get_noaa_atm(id, begin_date, end_date):
              'format' : 'json',
              'application' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'}
     
-    r = requests.get('https://api.tidesandcurrents.noaa.gov/api/prod/datagetter/', params=query)
-    
-    j = r.json()
-    
-    r_df = pd.DataFrame.from_dict(j["data"])
-    
-    r_df["t"] = pd.to_datetime(r_df["t"], utc=True); r_df["id"] = str(id); r_df["notes"] = "coop"
-    
-    r_df = r_df.loc[:,["id","t","v","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
+    r = requests.get(os.environ.get("NOAA_URL", 'https://api.tidesandcurrents.noaa.gov/api/prod/datagetter/'), params=query)
+    r.raise_for_status()
     
-    return r_df
+    return parse_noaa(r.content, id)
     
 def get_nws_atm(id, begin_date, end_date):
     """Retrieve atmospheric pressure data from the NWS API
@@ -128,7 +125,7 @@ def get_isu_atm(id, begin_date, end_date):
     new_end_date = pd.to_datetime(end_date, utc=True) 
     
     query = {'station' : str(id),
-             'data' : 'all',
+             'data' : 'alti',
              'year1' : new_begin_date.year,
              'month1' : new_begin_date.month,
              'day1' : new_begin_date.day,
@@ -137,21 +134,15 @@ def get_isu_atm(id, begin_date, end_date):
              'day2' : new_end_date.day + 1,
              'product' : 'air_pressure',
              'format' : 'comma',
-             'latlon' : 'yes'
+             'latlon' : 'no'
              }
     
-    r = requests.get(url = 'https://mesonet.agron.iastate.edu/cgi-bin/request/asos.py', params=query, headers={'User-Agent' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'})
+    r = requests.get(url = os.environ.get("ISU_URL", 'https://mesonet.agron.iastate.edu/cgi-bin/request/asos.py'), params=query, headers={'User-Agent' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'}, stream=True)
+    r.raise_for_status()
+    r.raw.decode_content = True
     
-    s = slicer(str(r.content, 'utf-8'), "station")
-    data = StringIO(s)
-    
-    r_df = pd.read_csv(filepath_or_buffer=data, lineterminator="\n", na_values=["","NA","M"])
-    
-    r_df["date"] = pd.to_datetime(r_df["valid"], utc=True); r_df["id"] = str(id); r_df["notes"] = "ISU"; r_df["pressure_mb"] = r_df["alti"] * 1000 * 0.0338639
-    
-    r_df = r_df.loc[:,["id","date","pressure_mb","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
-    
-    return r_df
+    with r:
+        return parse_isu(r.raw, id)
 
 def get_fiman_atm(id, begin_date, end_date):
     """Retrieve atmospheric pressure data from the NOAA tides and currents API
@@ -165,35 +156,26 @@ def get_fiman_atm(id, begin_date, end_date):
         r_df (pd.DataFrame): DataFrame of atmospheric pressure from specified station and time range. Dates in UTC
     """    
     
-    fiman_gauge_keys = pd.read_csv("data/fiman_gauge_key.csv").query("site_id == @id & Sensor == 'Barometric Pressure'")
+    site_id, sensor_id = fiman_gauge_key(id)
     
     new_begin_date = pd.to_datetime(begin_date, utc=True) - datetime.timedelta(seconds = 3600)
     new_end_date = pd.to_datetime(end_date, utc=True) + datetime.timedelta(seconds = 3600)
     
-    query = {'site_id' : fiman_gauge_keys.iloc[0]["site_id"],
+    query = {'site_id' : site_id,
              'data_start' : new_begin_date.strftime('%Y-%m-%d %H:%M:%S'),
              'end_date' : new_end_date.strftime('%Y-%m-%d %H:%M:%S'),
              'format_datetime' : '%Y-%m-%d %H:%M:%S',
              'tz' : 'utc',
              'show_raw' : True,
              'show_quality' : True,
-             'sensor_id' : fiman_gauge_keys.iloc[0]["sensor_id"]}
-    
-    r = requests.get(os.environ.get("FIMAN_URL"), params=query)
+             'sensor_id' : sensor_id}
     
-    j = r.content
+    r = requests.get(os.environ.get("FIMAN_URL"), params=query, stream=True)
+    r.raise_for_status()
+    r.raw.decode_content = True
     
-    doc = xmltodict.parse(j)
-    
-    unnested = doc["onerain"]["response"]["general"]["row"]
-    
-    r_df = pd.DataFrame.from_dict(unnested)
-
-    r_df["date"] = pd.to_datetime(r_df["data_time"], utc=True); r_df["id"] = str(id); r_df["notes"] = "FIMAN"
-    
-    r_df = r_df.loc[:,["id","date","data_value","notes"]].rename(columns = {"data_value":"pressure_mb"})
-    
-    return r_df
+    with r:
+        return parse_fiman(r.raw, id)
 
 #####################
 # atm API functions #
@@ -339,6 +321,134 @@ def format_interpolated_data(x):
     return formatted_data.drop_duplicates()
 
 
+def get_new_data(engine, partitions = None, raise_errors = False):
+    """Read unprocessed raw sensor data
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        partitions (list): Optional (place, sensor_ID) pairs to restrict the read to
+        raise_errors (bool): Re-raise a failed read instead of returning an empty DataFrame
+
+    Returns:
+        pd.DataFrame: Unprocessed rows, sorted by place and date
+    """
+    query = "SELECT * FROM sensor_data WHERE processed = 'FALSE' AND pressure > 800"
+    params = {}
+    
+    if partitions is not None:
+        if len(partitions) == 0:
+            return pd.DataFrame()
+        
+        query += ' AND (place, "sensor_ID") IN (SELECT * FROM unnest(:places, :sensors))'
+        params = {"places": [p[0] for p in partitions], "sensors": [p[1] for p in partitions]}
+    
+    with stage("read sensor_data") as info:
+        try:
+            new_data = read_sql_streamed(text(query), engine, params = params, chunksize = STREAM_CHUNK_ROWS)
+            new_data = new_data.sort_values(['place','date']).drop_duplicates() if new_data.shape[0] > 0 else new_data
+        except:
+            warnings.warn("Connection to database failed to return data")
+            if raise_errors:
+                raise
+            new_data = pd.DataFrame()
+        
+        info["rows"] = new_data.shape[0]
+    
+    return new_data
+
+
+def get_surveys(engine):
+    try:
+        surveys = pd.read_sql_table("sensor_surveys", engine).sort_values(['place','date_surveyed']).drop_duplicates()
+    except:
+        surveys = pd.DataFrame()
+        warnings.warn("Connection to database failed to return data")
+    
+    return surveys
+
+
+def process_new_data(new_data, surveys, engine, raise_errors = False, before_write = None):
+    """Convert raw sensor pressure to water depth and mark the raw rows as processed
+
+    Args:
+        new_data (pd.DataFrame): Unprocessed rows from `sensor_data`
+        surveys (pd.DataFrame): Rows from `sensor_surveys`
+        engine (sqlalchemy.engine.Engine): Database engine
+        raise_errors (bool): Re-raise failed atm interpolation and failed writes instead of only warning.
+            Rows deferred until atm pressure catches up are not an error
+        before_write (callable): Called before each write. An exception it raises stops processing
+
+    Returns:
+        pd.DataFrame: Rows written to `sensor_water_depth`. Empty if nothing could be processed
+    """
+    with stage("match_measurements_to_survey", rows = new_data.shape[0]):
+        prepared_data = match_measurements_to_survey(measurements = new_data, surveys = surveys)
+    
+    with stage("interpolate_atm_data", rows = prepared_data.shape[0]):
+        pending = None
+        try:
+            create_atm_grid_table(engine)
+            create_pending_table(engine)
+            pending = get_pending(engine)
+            prepared_data = hold_back_pending(prepared_data, pending)
+            interpolated_data = interpolate_atm_data_from_grid(prepared_data, engine)
+        except:
+            warnings.warn("Atm pressure grid unavailable, interpolating from raw atm observations")
+            pending = None
+            try: 
+                interpolated_data = interpolate_atm_data(prepared_data)
+            except: 
+                if raise_errors:
+                    raise
+                interpolated_data = pd.DataFrame()
+    
+    if pending is not None:
+        try:
+            update_pending(engine, prepared_data, interpolated_data, pending)
+        except:
+            warnings.warn("Error recording deferred observations")
+    
+    if interpolated_data.shape[0] == 0:
+        warnings.warn("No data to write to database!")
+
+        return pd.DataFrame()
+    
+    with stage("format_interpolated_data", rows = interpolated_data.shape[0]):
+        formatted_data = format_interpolated_data(interpolated_data)
+    
+    # Upsert the new data to the database table
+    with stage("write sensor_water_depth", rows = formatted_data.shape[0]):
+        if before_write is not None:
+            before_write()
+        try:
+            write_partitioned(formatted_data, "sensor_water_depth", engine, method = postgres_upsert, chunksize = chunk_size("write sensor_water_depth"))
+            print("Processed data to produce water depth!")
+        except:
+            warnings.warn("Error adding processed data to `sensor_water_depth`")
+            if raise_errors:
+                raise
+    
+    updated_raw_data = new_data.merge(formatted_data.reset_index().loc[:,["place","sensor_ID","date","sensor_water_depth"]], on=["place","sensor_ID","date"], how = "left")
+    updated_raw_data = updated_raw_data[updated_raw_data["sensor_water_depth"].notna()].drop(columns="sensor_water_depth")
+    updated_raw_data["processed"] = True
+    
+    updated_raw_data.set_index(['place', 'sensor_ID', 'date'], inplace=True)
+    
+    # Update raw data to indicate it has been processed
+    with stage("write sensor_data", rows = updated_raw_data.shape[0]):
+        if before_write is not None:
+            before_write()
+        try:
+            updated_raw_data.to_sql("sensor_data", engine, if_exists = "append", method=postgres_upsert, chunksize = chunk_size("write sensor_data"))
+            print("Updated raw data to indicate that it was processed!")
+        except:
+            warnings.warn("Error updating raw data with `processed` tag")
+            if raise_errors:
+                raise
+    
+    return formatted_data
+
+
 def main():
     
     # from env_vars import set_env_vars
@@ -359,63 +469,26 @@ def main():
     # Collect new data  #
     #####################
 
-    try:
-        new_data = pd.read_sql_query("SELECT * FROM sensor_data WHERE processed = 'FALSE' AND pressure > 800", engine).sort_values(['place','date']).drop_duplicates()
-    except:
-        new_data = pd.DataFrame()
-        warnings.warn("Connection to database failed to return data")
+    new_data = get_new_data(engine)
     
     if new_data.shape[0] == 0:
         warnings.warn("- No new raw data!")
         return
-        
-    sensors_w_new_data = list(new_data["sensor_ID"].unique())
     
-    try:
-        surveys = pd.read_sql_table("sensor_surveys", engine).sort_values(['place','date_surveyed']).drop_duplicates()
-    except:
-        surveys = pd.DataFrame()
-        warnings.warn("Connection to database failed to return data")
+    surveys = get_surveys(engine)
         
     if surveys.shape[0] == 0:
         warnings.warn("- No survey data!")
         return
-        
-    prepared_data = match_measurements_to_survey(measurements = new_data, surveys = surveys)
     
-    try: 
-        interpolated_data = interpolate_atm_data(prepared_data)
-    except: 
-        interpolated_data = pd.DataFrame()
+    formatted_data = process_new_data(new_data, surveys, engine)
     
-    if interpolated_data.shape[0] == 0:
-        warnings.warn("No data to write to database!")
-
-        return "No data to write to database!"
-    
-    formatted_data = format_interpolated_data(interpolated_data)
-    
-    # Upsert the new data to the database table
-    try:
-        formatted_data.to_sql("sensor_water_depth", engine, if_exists = "append", method=postgres_upsert)
-        print("Processed data to produce water depth!")
-    except:
-        warnings.warn("Error adding processed data to `sensor_water_depth`")
-    
-    updated_raw_data = new_data.merge(formatted_data.reset_index().loc[:,["place","sensor_ID","date","sensor_water_depth"]], on=["place","sensor_ID","date"], how = "left")
-    updated_raw_data = updated_raw_data[updated_raw_data["sensor_water_depth"].notna()].drop(columns="sensor_water_depth")
-    updated_raw_data["processed"] = True
-    
-    updated_raw_data.set_index(['place', 'sensor_ID', 'date'], inplace=True)
-    
-    # Update raw data to indicate it has been processed
-    try:
-        updated_raw_data.to_sql("sensor_data", engine, if_exists = "append", method=postgres_upsert)
-        print("Updated raw data to indicate that it was processed!")
-    except:
-        warnings.warn("Error updating raw data with `processed` tag")
+    report()
     
     engine.dispose()
+    
+    if formatted_data.shape[0] == 0:
+        return "No data to write to database!"
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
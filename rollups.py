@@ -0,0 +1,185 @@
+"""Hourly and daily rollups of data_for_display
+
+Rollup tables keep, per sensor and hour (or UTC day), the row count and the min/max/mean of
+`road_water_level_adj` and `sensor_water_level_adj`. They are maintained from just the
+rows each drift correction run changes: the buckets those rows fall in are recomputed from
+`data_for_display`, and no others. Recomputing rather than adding to the stored values keeps the
+rollups right the first time they are used and when two drift runs overlap on the same sensors.
+Buckets no run has touched yet (history from before the rollups existed) are filled by `rebuild`.
+
+There is no QA flag count: drift correction drops flagged rows before writing `data_for_display`,
+so it would always be 0. `rebuild` drops the column from tables created with it.
+
+Usage:
+    python rollups.py rebuild --start 2022-01-01 --end 2022-07-01
+"""
+
+import argparse
+import os
+import pandas as pd
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, Table, Text, create_engine, text
+
+SOURCE_TABLE = "data_for_display"
+MEASURES = ["road_water_level_adj", "sensor_water_level_adj"]
+
+# Rollup table -> (date_trunc unit, pandas frequency, bucket width)
+ROLLUPS = {"data_for_display_hourly": ("hour", "1H", "1 hour"),
+           "data_for_display_daily": ("day", "1D", "1 day")}
+
+metadata = MetaData()
+
+
+def rollup_table(name):
+    measure_columns = [Column(f"{measure}_{stat}", Integer if stat == "n" else Float)
+                       for measure in MEASURES for stat in ["n", "sum", "min", "max", "mean"]]
+
+    return Table(name, metadata,
+                 Column("place", Text, primary_key = True),
+                 Column("sensor_ID", Text, primary_key = True),
+                 Column("bucket", DateTime(timezone = True), primary_key = True),
+                 Column("n_rows", Integer),
+                 *measure_columns,
+                 Column("updated_at", DateTime(timezone = True)))
+
+
+ROLLUP_TABLES = {name: rollup_table(name) for name in ROLLUPS}
+
+
+########################
+# Utility functions    #
+########################
+
+def create_rollup_tables(engine):
+    metadata.create_all(engine, tables = list(ROLLUP_TABLES.values()), checkfirst = True)
+
+
+def bucket_keys(x, freq):
+    """Distinct (place, sensor_ID, bucket) of rows of `data_for_display` for buckets of `freq`"""
+    buckets = x.loc[:, ["place", "sensor_ID"]].copy()
+    buckets["bucket"] = pd.to_datetime(x["date"], utc = True).dt.floor(freq)
+
+    return buckets.drop_duplicates().reset_index(drop = True)
+
+
+########################
+# Maintenance          #
+########################
+
+def recompute_sql(table_name, unit, width, buckets_only):
+    measure_columns = ", ".join(f"{measure}_{stat}" for measure in MEASURES for stat in ["n", "sum", "min", "max", "mean"])
+    measure_aggregates = ", ".join(f"count(d.{m}), sum(d.{m}), min(d.{m}), max(d.{m}), avg(d.{m})" for m in MEASURES)
+    updates = ", ".join(f"{col} = excluded.{col}" for col in ["n_rows"] + measure_columns.split(", ") + ["updated_at"])
+
+    bucket_join = ""
+    if buckets_only:
+        bucket_join = f"""
+        JOIN unnest(CAST(:places AS text[]), CAST(:sensors AS text[]), CAST(:buckets AS timestamptz[])) AS t(place, sensor, bucket)
+          ON d.place = t.place AND d."sensor_ID" = t.sensor AND d.date >= t.bucket AND d.date < t.bucket + interval '{width}'"""
+
+    return text(f"""
+        INSERT INTO {table_name} (place, "sensor_ID", bucket, n_rows, {measure_columns}, updated_at)
+        SELECT d.place, d."sensor_ID", date_trunc('{unit}', d.date AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket,
+               count(*), {measure_aggregates}, now()
+        FROM {SOURCE_TABLE} d {bucket_join}
+        WHERE d.date >= :start_date AND d.date < :end_date
+        GROUP BY 1, 2, 3
+        ON CONFLICT ON CONSTRAINT {table_name}_pkey DO UPDATE SET {updates}
+    """)
+
+
+def recompute_buckets(conn, table_name, unit, width, buckets):
+    """Recompute the given (place, sensor_ID, bucket) rows of a rollup from data_for_display"""
+    params = {"places": list(buckets["place"]),
+              "sensors": list(buckets["sensor_ID"]),
+              "buckets": [b.to_pydatetime() for b in buckets["bucket"]],
+              "start_date": buckets["bucket"].min().to_pydatetime(),
+              "end_date": (buckets["bucket"].max() + pd.Timedelta(width)).to_pydatetime()}
+
+    conn.execute(recompute_sql(table_name, unit, width, buckets_only = True), params)
+
+
+def update_rollups(engine, inserted, updated):
+    """Recompute the rollup buckets touched by the rows a drift correction run changed
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        inserted (pd.DataFrame): Rows newly inserted into data_for_display
+        updated (pd.DataFrame): Rows of data_for_display whose values changed
+
+    Returns:
+        dict: Number of recomputed buckets per rollup table
+    """
+    changed = pd.concat([inserted, updated], ignore_index = True)
+
+    if changed.shape[0] == 0:
+        return {}
+
+    create_rollup_tables(engine)
+
+    counts = {}
+
+    with engine.begin() as conn:
+        for table_name, (unit, freq, width) in ROLLUPS.items():
+            buckets = bucket_keys(changed, freq)
+            recompute_buckets(conn, table_name, unit, width, buckets)
+            counts[table_name] = buckets.shape[0]
+
+    return counts
+
+
+def rebuild_rollups(engine, start_date, end_date):
+    """Recompute every bucket between two dates from data_for_display"""
+    create_rollup_tables(engine)
+
+    with engine.begin() as conn:
+        for table_name, (unit, freq, width) in ROLLUPS.items():
+            conn.execute(text(f"ALTER TABLE {table_name} DROP COLUMN IF EXISTS qa_qc_flag_count"))
+            conn.execute(recompute_sql(table_name, unit, width, buckets_only = False), {"start_date": start_date, "end_date": end_date})
+
+
+def read_rollup(engine, resolution, start_date, end_date, sensors = None):
+    """Read hourly or daily rollups for a date range
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        resolution (str): "hourly" or "daily"
+        start_date (pd.Timestamp): Beginning of the range
+        end_date (pd.Timestamp): End of the range
+        sensors (list): Only return these sensors. Default: all
+
+    Returns:
+        pd.DataFrame: Rollup rows
+    """
+    query = f"SELECT * FROM data_for_display_{resolution} WHERE bucket >= :start_date AND bucket <= :end_date"
+    params = {"start_date": pd.Timestamp(start_date), "end_date": pd.Timestamp(end_date)}
+
+    if sensors is not None:
+        query += ' AND "sensor_ID" = ANY(:sensors)'
+        params["sensors"] = list(sensors)
+
+    return pd.read_sql_query(text(query + ' ORDER BY place, "sensor_ID", bucket'), engine, params = params)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Maintain hourly and daily rollups of data_for_display")
+    parser.add_argument("command", choices = ["rebuild"])
+    parser.add_argument("--start", required = True, help = "First date to rebuild (UTC)")
+    parser.add_argument("--end", required = True, help = "Date to rebuild up to, exclusive (UTC)")
+    args = parser.parse_args()
+
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+    start_date = pd.Timestamp(args.start, tz = "UTC").floor("1D")
+    end_date = pd.Timestamp(args.end, tz = "UTC").ceil("1D")
+
+    rebuild_rollups(engine, start_date.to_pydatetime(), end_date.to_pydatetime())
+    print(f"- Rebuilt rollups from {start_date.date()} to {end_date.date()}")
+
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Deterministic synthetic series shared by the load test and the offline checks
+
+Every series is a function of the station or sensor ID and the timestamps only, so repeated runs
+see the same values.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def station_offset(station_id):
+    return (sum(ord(c) for c in str(station_id)) % 17) - 8
+
+
+def synthetic_atm_pressure(station_id, dates):
+    """Deterministic atm pressure (mb) for a station, so every run sees the same series"""
+    hours = pd.DatetimeIndex(dates).asi8 / 3.6e12
+
+    return 1013.25 + station_offset(station_id) * 0.5 + 8 * np.sin(2 * np.pi * hours / 120)
+
+
+def synthetic_water_depth(sensor_ID, dates):
+    """Tidal water depth (ft) with a slow drift, never below zero"""
+    hours = pd.DatetimeIndex(dates).asi8 / 3.6e12
+    phase = station_offset(sensor_ID)
+
+    return np.clip(0.4 + 0.5 * np.sin(2 * np.pi * (hours + phase) / 12.42) + 0.001 * (hours % 720), 0, None)